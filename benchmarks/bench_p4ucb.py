@@ -0,0 +1,183 @@
+"""Time P4UCB.py's hot paths headless, against the fake server in fakes.py.
+
+No Maya and no Perforce server are needed:
+
+    python benchmarks/bench_p4ucb.py --sizes 100,1000,10000,100000 --latency 0.005
+
+`--latency` is the simulated round-trip per command in seconds, `--sizes` the
+number of files in the depot. Results are printed as a table of milliseconds
+(median of `--repeat` runs) and can be written as JSON with `--output`.
+"""
+import argparse
+import configparser
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import fakes
+
+
+BENCHMARKS = []
+
+def benchmark(name):
+    """Register a benchmark: a function(plugin, server) returning the callable to time."""
+    def register(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return register
+
+
+def loadPlugin(server):
+    cmds = fakes.install(server)
+    sys.path.insert(0, os.path.join(HERE, '..', 'plug-ins'))
+    import P4UCB
+
+    parser = configparser.ConfigParser()
+    parser['DEFAULT'] = {
+        'port': 'bench:1666',
+        'user': 'artist',
+        'password': 'secret',
+        'client': fakes.CLIENT,
+        'keepalive_interval': '0',
+    }
+    P4UCB.config = parser['DEFAULT']
+    scratch = tempfile.mkdtemp(prefix='p4ucb_bench')
+    P4UCB.pendingSubmits.path = os.path.join(scratch, 'pending_submits.json')
+    P4UCB.digestCache.path = os.path.join(scratch, 'digest_cache.db')
+    return P4UCB, cmds
+
+
+def resetPlugin(plugin):
+    if plugin.p4.connected():
+        plugin.p4.disconnect()
+    plugin.openedIndex.invalidate()
+    plugin.fileStates.clear()
+
+
+def waitForWorker(plugin):
+    while plugin.syncWorker.isBusy() or plugin.submitWorker.isBusy():
+        time.sleep(0.001)
+    fakes.runDeferred()
+
+
+@benchmark('connectToP4')
+def benchConnect(plugin, server):
+    def run():
+        plugin.p4.disconnect()
+        plugin.connectToP4()
+    return run
+
+
+@benchmark('p4GetLatest')
+def benchGetLatest(plugin, server):
+    def run():
+        plugin.p4GetLatest(verbose=False)
+        waitForWorker(plugin)
+    return run
+
+
+@benchmark('p4Submit')
+def benchSubmit(plugin, server):
+    openedCount = min(server.depotSize, 1000)
+    def run():
+        server.opened = {server.depotFile(n): 'edit' for n in range(openedCount)}
+        plugin.openedIndex.invalidate()
+        plugin.p4Submit()
+        waitForWorker(plugin)
+    return run
+
+
+@benchmark('save_callback')
+def benchSave(plugin, server):
+    return plugin.save_callback
+
+
+@benchmark('afterOpen_callback')
+def benchAfterOpen(plugin, server):
+    def run():
+        plugin.afterOpen_callback()
+    return run
+
+
+@benchmark('run_filelog')
+def benchFilelog(plugin, server):
+    return lambda: plugin.p4.run_filelog('//...')
+
+
+@benchmark('run_filelog(compact)')
+def benchFilelogCompact(plugin, server):
+    return lambda: plugin.p4.run_filelog('//...', compact=True)
+
+
+@benchmark('run_print')
+def benchPrint(plugin, server):
+    return lambda: plugin.p4.run_print('//...')
+
+
+@benchmark('iterate_clients')
+def benchIterateClients(plugin, server):
+    return lambda: list(plugin.p4.iterate_clients())
+
+
+@benchmark('iterate_clients(prefetch)')
+def benchIterateClientsPrefetch(plugin, server):
+    return lambda: list(plugin.p4.iterate_clients(prefetch=32))
+
+
+def timeBenchmark(plugin, server, func, repeat):
+    run = func(plugin, server)
+    times = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull): # the plug-in's chatter
+        plugin.connectToP4()
+        for i in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+            waitForWorker(plugin) # background work started by run() is not part of its time
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        help='comma separated depot sizes in files (up to 1000000)')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per server round-trip')
+    parser.add_argument('--revisions', type=int, default=5, help='revisions per file for filelog')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', default='', help='comma separated benchmark names to run')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    only = set(name for name in args.only.split(',') if name)
+    selected = [(name, func) for name, func in BENCHMARKS if not only or name in only]
+
+    server = fakes.FakeServer(latency=args.latency, revisions=args.revisions)
+    plugin, cmds = loadPlugin(server)
+
+    results = {}
+    print('{:<24}'.format('ms') + ''.join('{:>12}'.format(size) for size in sizes))
+    for name, func in selected:
+        row = results.setdefault(name, {})
+        for size in sizes:
+            server.depotSize = size
+            server.opened = {}
+            resetPlugin(plugin)
+            row[size] = timeBenchmark(plugin, server, func, args.repeat) * 1000
+        print('{:<24}'.format(name) + ''.join('{:>12.1f}'.format(row[size]) for size in sizes))
+        sys.stdout.flush()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'latency': args.latency, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+"""Stand-ins for P4API and maya so P4UCB.py can be imported and timed headless.
+
+install() must run before P4 or P4UCB is imported. The fake P4API serves a
+generated depot of any size from memory and sleeps `latency` seconds per
+command to model the round-trip to a real server; the fake maya modules answer
+every dialog with a fixed button and record nothing but what the harness needs.
+"""
+import sys
+import time
+import types
+import threading
+
+
+DEPOT = '//Animation_Production'
+CLIENT = 'bench_ws'
+CLIENT_ROOT = '/bench/' + CLIENT
+
+
+class FakeServer:
+    """An in-memory depot of `depotSize` files, `revisions` revisions each."""
+
+    def __init__(self, depotSize=1000, latency=0.0, revisions=5, fileSize=1024 * 1024, printSize=64, clients=100):
+        self.depotSize = depotSize
+        self.latency = latency
+        self.revisions = revisions
+        self.fileSize = fileSize
+        self.printSize = printSize
+        self.clients = clients
+        self.opened = {}
+        self.change = 1
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    def depotFile(self, n):
+        return '{}/seq{:03d}/shot{:04d}/file{:07d}.ma'.format(DEPOT, n // 10000, (n // 100) % 100, n)
+
+    def allFiles(self):
+        return (self.depotFile(n) for n in range(self.depotSize))
+
+    def expand(self, args):
+        """Depot paths named by file arguments; wildcards and client syntax match everything."""
+        files = []
+        for arg in args:
+            path = arg.split('#')[0].split('@')[0]
+            if '...' in path or '*' in path:
+                prefix = path.split('...')[0].split('*')[0]
+                if prefix.startswith('//' + CLIENT + '/'):
+                    prefix = DEPOT + '/' + prefix[len(CLIENT) + 3:]
+                files.extend(f for f in self.allFiles() if f.startswith(prefix))
+            else:
+                files.append(path)
+        return files
+
+    def inDepot(self, depotFile):
+        return depotFile.startswith(DEPOT + '/seq') and depotFile.endswith('.ma')
+
+
+class FakeAdapter:
+    """Implements the P4API.P4Adapter surface that P4.py and P4UCB.py use."""
+
+    server = None # shared FakeServer, set by install()
+
+    __members__ = ['port', 'user', 'client', 'password', 'tagged', 'handler', 'exception_level',
+                   'cwd', 'input', 'charset', 'prog', 'progress', 'logger', 'encoding']
+
+    def __init__(self, *args, **kwargs):
+        self.port = ''
+        self.user = ''
+        self.client = ''
+        self.password = ''
+        self.charset = 'none'
+        self.prog = 'bench'
+        self.tagged = 1
+        self.handler = None
+        self.logger = None
+        self.encoding = 'utf8'
+        self.exception_level = 2
+        self.progress = None
+        self.input = None
+        self.cwd = CLIENT_ROOT
+        self.messages = []
+        self.errors = []
+        self.warnings = []
+        self.ticket_file = '/nonexistent/.p4tickets'
+        self.server_level = 50
+        self.debug = 0
+        self.resolver = None
+        self.isConnected = False
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def connected(self):
+        return self.isConnected
+
+    def connect(self):
+        time.sleep(self.server.latency)
+        self.isConnected = True
+
+    def disconnect(self):
+        self.isConnected = False
+
+    def is_ignored(self, path):
+        return False
+
+    def run(self, *args):
+        args = [a.decode() if isinstance(a, bytes) else a for a in args]
+        server = self.server
+        time.sleep(server.latency)
+        with server.lock:
+            server.commands += 1
+        self.errors = []
+        self.warnings = []
+        command, args = args[0], list(args[1:])
+        options = [a for a in args if a.startswith('-')]
+        fileArgs = [a for a in args if not a.startswith('-')]
+        method = getattr(self, 'cmd_' + command, None)
+        result = method(options, fileArgs) if method else []
+
+        if self.handler is not None:
+            kept = []
+            for record in result:
+                if isinstance(record, dict):
+                    code = self.handler.outputStat(record)
+                elif isinstance(record, bytes):
+                    code = self.handler.outputBinary(record)
+                else:
+                    code = self.handler.outputText(record)
+                if code == 0:
+                    kept.append(record)
+                elif code == 2:
+                    break
+            return kept
+        return list(result)
+
+    def warn(self, message):
+        self.warnings.append(message)
+        if self.exception_level >= 2:
+            raise sys.modules['P4'].P4Exception("[Warning]: '{}'".format(message))
+
+    # commands
+
+    def cmd_login(self, options, files):
+        return [{'User': self.user}]
+
+    def cmd_info(self, options, files):
+        return [{'clientName': self.client, 'clientRoot': CLIENT_ROOT}]
+
+    def cmd_sync(self, options, files):
+        server = self.server
+        targets = server.expand(files) if files else list(server.allFiles())
+        result = [{'depotFile': f, 'rev': str(server.revisions), 'action': 'updated',
+                   'fileSize': str(server.fileSize), 'clientFile': CLIENT_ROOT + f[len(DEPOT):]}
+                  for f in targets if server.inDepot(f)]
+        if not result:
+            self.warn('File(s) up-to-date.')
+        return result
+
+    def cmd_sizes(self, options, files):
+        return [{'depotFile': f, 'rev': str(self.server.revisions), 'fileSize': str(self.server.fileSize)}
+                for f in self.server.expand(files)]
+
+    def cmd_have(self, options, files):
+        server = self.server
+        targets = server.expand(files) if files else server.allFiles()
+        return [{'depotFile': f, 'clientFile': CLIENT_ROOT + f[len(DEPOT):], 'haveRev': str(server.revisions)}
+                for f in targets]
+
+    def cmd_files(self, options, files):
+        server = self.server
+        result = [{'depotFile': f, 'rev': str(server.revisions), 'action': 'edit', 'type': 'binary+l',
+                   'change': str(server.change)} for f in server.expand(files) if server.inDepot(f)]
+        if not result and not any('@' in f for f in files):
+            self.warn('no such file(s).')
+        return result
+
+    def cmd_fstat(self, options, files):
+        server = self.server
+        result = []
+        for f in server.expand(files):
+            if server.inDepot(f):
+                record = {'depotFile': f, 'clientFile': CLIENT_ROOT + f[len(DEPOT):],
+                          'headRev': str(server.revisions), 'headAction': 'edit', 'headType': 'binary+l',
+                          'haveRev': str(server.revisions), 'fileSize': str(server.fileSize),
+                          'digest': '0' * 32}
+                if f in server.opened:
+                    record['action'] = server.opened[f]
+                result.append(record)
+        if not result:
+            self.warn('no such file(s).')
+        return result
+
+    def cmd_changes(self, options, files):
+        return [{'change': str(self.server.change), 'status': 'submitted'}]
+
+    def cmd_opened(self, options, files):
+        opened = self.server.opened
+        wanted = set(self.server.expand(files)) if files else None
+        result = [{'depotFile': f, 'action': action, 'change': 'default', 'type': 'binary+l',
+                   'user': self.user, 'client': self.client}
+                  for f, action in list(opened.items()) if wanted is None or f in wanted]
+        if not result:
+            self.warn('File(s) not opened on this client.')
+        return result
+
+    def openFiles(self, files, action):
+        result = []
+        with self.server.lock:
+            for f in self.server.expand(files):
+                self.server.opened[f] = action
+                result.append({'depotFile': f, 'clientFile': CLIENT_ROOT + f[len(DEPOT):],
+                               'action': action, 'workRev': str(self.server.revisions)})
+        return result
+
+    def cmd_edit(self, options, files):
+        return self.openFiles(files, 'edit')
+
+    def cmd_add(self, options, files):
+        return self.openFiles(files, 'add')
+
+    def cmd_lock(self, options, files):
+        return [{'depotFile': f, 'action': 'locked'} for f in self.server.expand(files)]
+
+    def cmd_revert(self, options, files):
+        result = []
+        with self.server.lock:
+            for f in self.server.expand(files):
+                if self.server.opened.pop(f, None):
+                    result.append({'depotFile': f, 'action': 'reverted'})
+        return result
+
+    def cmd_change(self, options, files):
+        if '-o' in options:
+            spec = sys.modules['P4'].Spec({'change': 'Change', 'description': 'Description', 'files': 'Files',
+                                           'client': 'Client', 'user': 'User', 'status': 'Status'})
+            spec['Change'] = 'new'
+            spec['Client'] = self.client
+            spec['User'] = self.user
+            spec['Status'] = 'new'
+            spec['Description'] = '<enter description here>'
+            spec['Files'] = sorted(f for f, action in self.server.opened.items())
+            return [spec]
+        with self.server.lock:
+            self.server.change += 1
+            return ['Change {} created.'.format(self.server.change)]
+
+    def cmd_submit(self, options, files):
+        server = self.server
+        spec = self.input
+        submitted = list(spec['Files']) if isinstance(spec, dict) and 'Files' in spec else list(server.opened)
+        with server.lock:
+            server.change += 1
+            for f in submitted:
+                server.opened.pop(f, None)
+        result = [{'change': str(server.change), 'openFiles': str(len(submitted))}]
+        result.extend({'depotFile': f, 'rev': str(server.revisions + 1), 'action': 'edit'} for f in submitted)
+        result.append({'submittedChange': str(server.change)})
+        return result
+
+    def cmd_filelog(self, options, files):
+        server = self.server
+        revs = server.revisions
+        result = []
+        for f in server.expand(files):
+            result.append({
+                'depotFile': f,
+                'rev': [str(r) for r in range(revs, 0, -1)],
+                'change': [str(1000 + r) for r in range(revs, 0, -1)],
+                'action': ['edit'] * (revs - 1) + ['add'],
+                'type': ['binary+l'] * revs,
+                'time': [str(1600000000 + r * 3600) for r in range(revs, 0, -1)],
+                'user': ['artist'] * revs,
+                'client': [CLIENT] * revs,
+                'desc': ['update shot\n'] * revs,
+                'digest': ['0' * 32] * revs,
+                'fileSize': [str(server.fileSize)] * revs,
+            })
+        return result
+
+    def cmd_print(self, options, files):
+        chunk = b'x' * self.server.printSize
+        for f in self.server.expand(files):
+            yield {'depotFile': f, 'rev': str(self.server.revisions), 'type': 'binary+l',
+                   'fileSize': str(self.server.printSize)}
+            yield chunk
+
+    def cmd_clients(self, options, files):
+        return [{'client': 'ws{:05d}'.format(n), 'Owner': 'artist'} for n in range(self.server.clients)]
+
+    def cmd_client(self, options, files):
+        name = files[-1] if files else self.client
+        spec = sys.modules['P4'].Spec({'client': 'Client', 'owner': 'Owner', 'root': 'Root', 'view': 'View'})
+        spec['Client'] = name
+        spec['Owner'] = 'artist'
+        spec['Root'] = '/bench/' + name
+        spec['View'] = ['{}/... //{}/...'.format(DEPOT, name)]
+        return [spec]
+
+    def parse_spec(self, spectype, form):
+        return sys.modules['P4'].Spec(None)
+
+    def format_spec(self, spectype, spec):
+        return ''
+
+
+class FakeMap:
+    """Enough of P4API.P4Map for single '...' wildcard mappings."""
+
+    def __init__(self, *args):
+        self.entries = []
+
+    def insert(self, left, right=None):
+        exclude = left.startswith('-')
+        left = left.lstrip('+-')
+        if right is None:
+            if ' ' in left:
+                left, right = left.split(' ', 1)
+            else:
+                right = left
+        self.entries.append((left.strip(), right.strip(), exclude))
+
+    def count(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries = []
+
+    def as_array(self):
+        return ['{}{} {}'.format('-' if exclude else '', left, right) for left, right, exclude in self.entries]
+
+    def reverse(self):
+        reversed_map = FakeMap()
+        reversed_map.entries = [(right, left, exclude) for left, right, exclude in self.entries]
+        return reversed_map
+
+    def translate(self, path, direction=True):
+        for left, right, exclude in reversed(self.entries):
+            source, target = (left, right) if direction else (right, left)
+            prefix = source.split('...')[0]
+            if path.startswith(prefix) if '...' in source else path == source:
+                if exclude:
+                    return None
+                return target.split('...')[0] + path[len(prefix):] if '...' in source else target
+        return None
+
+
+class FakeCmds:
+    """maya.cmds: every command is a no-op except the few the plug-in reads back."""
+
+    def __init__(self):
+        self.sceneName = CLIENT_ROOT + '/seq000/shot0000/file0000000.ma'
+        self.sceneFiles = [self.sceneName]
+        self.answers = {'confirmDialog': 'cancel', 'promptDialog': 'Submit'}
+        self.buttons = {}
+        self.values = {}
+
+    def file(self, *args, **kwargs):
+        if kwargs.get('list'):
+            return list(self.sceneFiles)
+        if kwargs.get('sn') or kwargs.get('sceneName'):
+            return self.sceneName
+        return None
+
+    def workspace(self, *args, **kwargs):
+        return CLIENT_ROOT + '/'
+
+    def button(self, *args, **kwargs):
+        name = 'button{}'.format(len(self.buttons))
+        self.buttons[kwargs.get('label')] = kwargs.get('c') or kwargs.get('command')
+        return name
+
+    def checkBox(self, name, **kwargs):
+        if kwargs.get('query'):
+            return self.values.get(name, True)
+        self.values[name] = kwargs.get('value', True)
+        return name
+
+    def layoutDialog(self, *args, **kwargs):
+        if 'ui' in kwargs:
+            self.buttons = {}
+            kwargs['ui']()
+            submit = self.buttons.get('Continue') or self.buttons.get('Submit')
+            if callable(submit):
+                submit()
+        return None
+
+    def promptDialog(self, *args, **kwargs):
+        if kwargs.get('query'):
+            return 'benchmark'
+        return self.answers['promptDialog']
+
+    def confirmDialog(self, *args, **kwargs):
+        return self.answers['confirmDialog']
+
+    def ls(self, *args, **kwargs):
+        return []
+
+    def allNodeTypes(self, *args, **kwargs):
+        return []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+deferred = []
+
+def executeDeferred(function, *args, **kwargs):
+    deferred.append((function, args, kwargs))
+
+def runDeferred():
+    """Run what the plug-in posted to the (fake) main thread."""
+    while deferred:
+        function, args, kwargs = deferred.pop(0)
+        function(*args, **kwargs)
+
+
+def module(name, **attributes):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attributes)
+    sys.modules[name] = mod
+    return mod
+
+
+def install(server):
+    """Register the fake modules in sys.modules, serving `server`."""
+    FakeAdapter.server = server
+    module('P4API', P4Adapter=FakeAdapter, P4Map=FakeMap, identify=lambda: 'P4API fake')
+
+    class MSceneMessage:
+        kAfterSave, kAfterNew, kAfterOpen, kMayaExiting, kBeforeNew = range(5)
+
+        @staticmethod
+        def addCallback(event, function):
+            return (event, function)
+
+    class MCommandMessage:
+        @staticmethod
+        def removeCallback(callbackId):
+            pass
+
+    cmds = FakeCmds()
+    openMaya = module('maya.OpenMaya', MSceneMessage=MSceneMessage, MCommandMessage=MCommandMessage)
+    openMayaMPx = module('maya.OpenMayaMPx', MFnPlugin=lambda mobject: None)
+    mel = module('maya.mel', eval=lambda command: 'MainWindow')
+    utils = module('maya.utils', executeDeferred=executeDeferred)
+    module('maya', cmds=cmds, OpenMaya=openMaya, OpenMayaMPx=openMayaMPx, mel=mel, utils=utils)
+    sys.modules['maya.cmds'] = cmds
+    return cmds
@@ -43,13 +43,36 @@ from __future__ import print_function
     See accompanying LICENSE.txt including for redistribution permission.
     """
 
-import sys, datetime
+import sys, datetime, time
 import re
 import shutil
 from contextlib import contextmanager
 import uuid, tempfile
 import os, os.path, platform
+import io
+import collections, itertools
 import subprocess
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import asyncio
+    import concurrent.futures
+except ImportError:
+    asyncio = None # Python 2, AsyncP4 is not available
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time # Python 2
+
+try:
+    _intern = sys.intern
+except AttributeError:
+    _intern = intern # Python 2
 
 # P4Exception - some sort of error occurred
 class P4Exception(Exception):
@@ -212,6 +235,100 @@ class DepotFile:
     def __repr__(self):
         return "DepotFile (depotFile = %s, %s revisions)" % ( self.depotFile, len( self.revisions ) )
 
+#
+# Compact variants of the filelog classes above, returned by
+# p4.run_filelog(..., compact=True) for tools that walk long histories.
+# They use __slots__, keep no empty integration lists, share interned
+# strings for action, type, user and client, and store the raw time
+# stamp, converting it to a datetime only when it is read.
+#
+
+class CompactIntegration(object):
+    __slots__ = ('how', 'file', 'srev', 'erev')
+    
+    def __init__( self, how, file, srev, erev ):
+        self.how = how
+        self.file = file
+        self.srev = srev
+        self.erev = erev
+    
+    def __repr__(self):
+        return "Integration (how = %s file = %s srev = %s erev = %s)" \
+            % (self.how, self.file, self.srev, self.erev)
+
+class CompactRevision(object):
+    __slots__ = ('depotFile', '_integrations', 'rev', 'change', 'action', 'type', '_time',
+                 'user', 'client', 'desc', 'digest', 'fileSize')
+    
+    def __init__( self, depotFile ):
+        self.depotFile = depotFile
+        self._integrations = None
+        self.rev = None
+        self.change = None
+        self.action = None
+        self.type = None
+        self._time = None
+        self.user = None
+        self.client = None
+        self.desc = None
+        self.digest = None
+        self.fileSize = None
+    
+    @property
+    def time(self):
+        if isinstance(self._time, int):
+            return datetime.datetime.utcfromtimestamp( self._time )
+        return self._time
+    
+    @time.setter
+    def time(self, value):
+        self._time = value
+    
+    @property
+    def integrations(self):
+        if self._integrations is None:
+            return ()
+        return self._integrations
+    
+    def integration( self, how, file, srev, erev ):
+        rec = CompactIntegration( how, file, srev, erev )
+        if self._integrations is None:
+            self._integrations = []
+        self._integrations.append( rec )
+        return rec
+    
+    def each_integration(self):
+        for i in self.integrations:
+            yield i
+    
+    def __repr__(self):
+        return "Revision (depotFile = %s rev = %s change = %s action = %s type = %s time = %s user = %s client = %s)" % \
+            (self.depotFile, self.rev, self.change, self.action, self.type, self.time, self.user, self.client)
+
+class CompactDepotFile(object):
+    __slots__ = ('depotFile', 'revisions')
+    
+    def __init__( self, name ):
+        self.depotFile = name
+        self.revisions = []
+    
+    def new_revision(self):
+        r = CompactRevision( self.depotFile )
+        self.revisions.append( r )
+        return r
+    
+    def each_revision(self):
+        for r in self.revisions:
+            yield r
+    
+    # the formatting is identical to DepotFile
+    str_revision = DepotFile.__dict__['str_revision']
+    str_integration = DepotFile.__dict__['str_integration']
+    __str__ = DepotFile.__dict__['__str__']
+    
+    def __repr__(self):
+        return "DepotFile (depotFile = %s, %s revisions)" % ( self.depotFile, len( self.revisions ) )
+
 #
 # Resolver class used in p4.run_resolve()
 #
@@ -287,6 +404,93 @@ class ReportHandler( OutputHandler ):
         print( "error:", e)
         return OutputHandler.HANDLED
 
+#
+# StreamingOutputHandler feeds P4.stream()
+#
+# Every record is put on a bounded queue instead of being collected in
+# the result list, so the producer blocks once the consumer falls
+# behind. Messages are still reported so that errors raise as usual.
+#
+
+class StreamingOutputHandler( OutputHandler ):
+    def __init__(self, records, cancelled):
+        OutputHandler.__init__(self)
+        self.records = records
+        self.cancelled = cancelled
+    
+    def put(self, item):
+        while not self.cancelled.is_set():
+            try:
+                self.records.put(item, timeout=0.1)
+                return OutputHandler.HANDLED
+            except queue.Full:
+                pass
+        return OutputHandler.CANCEL
+    
+    def outputText(self, s):
+        return self.put(s)
+    
+    def outputBinary(self, b):
+        return self.put(b)
+    
+    def outputStat(self, h):
+        return self.put(h)
+    
+    def outputInfo(self, i):
+        return self.put(i)
+
+#
+# PrintOutputHandler is used by P4.run_print_to()
+#
+# File contents are written to a sink as the chunks arrive instead of
+# being collected. The sink for each file comes from a factory called
+# with the file's tagged dict.
+#
+
+class PrintOutputHandler( OutputHandler ):
+    def __init__(self, factory, encoding):
+        OutputHandler.__init__(self)
+        self.factory = factory
+        self.encoding = encoding
+        self.files = []
+        self.sink = None
+        self.close_sink = False
+    
+    def outputStat(self, h):
+        self.close()
+        self.files.append(h)
+        (self.sink, self.close_sink) = self.factory(h)
+        return OutputHandler.HANDLED
+    
+    def outputText(self, s):
+        return self.write(s)
+    
+    def outputBinary(self, b):
+        return self.write(b)
+    
+    def write(self, chunk):
+        if self.sink is None:
+            return OutputHandler.REPORT
+        if isinstance(self.sink, bytearray):
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(self.encoding)
+            self.sink.extend(chunk)
+        elif isinstance(self.sink, io.TextIOBase):
+            if isinstance(chunk, bytes):
+                chunk = chunk.decode(self.encoding)
+            self.sink.write(chunk)
+        else:
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode(self.encoding)
+            self.sink.write(chunk)
+        return OutputHandler.HANDLED
+    
+    def close(self):
+        if self.sink is not None and self.close_sink:
+            self.sink.close()
+        self.sink = None
+        self.close_sink = False
+
 class Progress:
     TYPE_SENDFILE = 1
     TYPE_RECEIVEFILE = 2
@@ -344,20 +548,149 @@ class TextProgress(Progress):
         Progress.done(self, fail)
         print( "Progress.done with '%s"'' % fail )
 
-def processFilelog(h):
+#
+# CommandStats and P4Stats record how long commands take
+#
+# Enable with p4.enable_stats(). One P4Stats can be shared by several P4
+# objects (e.g. worker connections) to get a single report. Timings go
+# into fixed millisecond buckets so recording is cheap and memory stays
+# constant however many commands are run.
+#
+
+class CommandStats:
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+    
+    def __init__(self):
+        self.calls = 0
+        self.round_trips = 0
+        self.errors = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+        self.results = 0
+        self.bytes = 0
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+    
+    def record(self, elapsed, results, size, round_trips, failed):
+        self.calls += 1
+        self.round_trips += round_trips
+        if failed:
+            self.errors += 1
+        self.total += elapsed
+        if self.min is None or elapsed < self.min:
+            self.min = elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+        self.results += results
+        self.bytes += size
+        
+        ms = elapsed * 1000
+        for n, bound in enumerate(self.BUCKETS):
+            if ms <= bound:
+                self.histogram[n] += 1
+                return
+        self.histogram[-1] += 1
+    
+    def percentile(self, fraction):
+        """Upper bound in ms of the bucket holding the given fraction of calls"""
+        wanted = fraction * self.calls
+        seen = 0
+        for n, count in enumerate(self.histogram):
+            seen += count
+            if count and seen >= wanted:
+                return min(self.BUCKETS[n], self.max * 1000) if n < len(self.BUCKETS) else self.max * 1000
+        return 0
+    
+    def as_dict(self):
+        return {
+            "calls": self.calls,
+            "round_trips": self.round_trips,
+            "errors": self.errors,
+            "total_ms": self.total * 1000,
+            "mean_ms": self.total * 1000 / self.calls if self.calls else 0,
+            "min_ms": (self.min or 0) * 1000,
+            "max_ms": self.max * 1000,
+            "p50_ms": self.percentile(0.5),
+            "p90_ms": self.percentile(0.9),
+            "p99_ms": self.percentile(0.99),
+            "results": self.results,
+            "bytes": self.bytes,
+            "histogram": dict(zip([ "<=%dms" % b for b in self.BUCKETS ] + [ ">%dms" % self.BUCKETS[-1] ], self.histogram)),
+        }
+
+class P4Stats:
+    def __init__(self, count_bytes=False):
+        self.count_bytes = count_bytes
+        self.commands = {}
+        self.lock = threading.Lock()
+    
+    def record(self, cmd, elapsed, results=0, size=0, round_trips=1, failed=False):
+        with self.lock:
+            stats = self.commands.get(cmd)
+            if stats is None:
+                stats = self.commands[cmd] = CommandStats()
+            stats.record(elapsed, results, size, round_trips, failed)
+    
+    def measure(self, result):
+        """Result count and (if count_bytes is set) approximate size of a result list"""
+        if not isinstance(result, list):
+            return 0, 0
+        if not self.count_bytes:
+            return len(result), 0
+        size = 0
+        for r in result:
+            if isinstance(r, dict):
+                for v in r.values():
+                    if isinstance(v, (str, bytes)):
+                        size += len(v)
+            elif isinstance(r, (str, bytes)):
+                size += len(r)
+        return len(result), size
+    
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+    
+    def as_dict(self):
+        with self.lock:
+            return dict((cmd, stats.as_dict()) for (cmd, stats) in self.commands.items())
+    
+    def report(self):
+        """Text table of all commands, slowest total first"""
+        rows = sorted(self.as_dict().items(), key=lambda x: -x[1]["total_ms"])
+        lines = [ "%-32s %7s %10s %9s %9s %9s %10s" % ("command", "calls", "total ms", "mean ms", "p90 ms", "max ms", "results") ]
+        for (cmd, s) in rows:
+            lines.append( "%-32s %7d %10.1f %9.1f %9.1f %9.1f %10d" % \
+                (cmd, s["calls"], s["total_ms"], s["mean_ms"], s["p90_ms"], s["max_ms"], s["results"]) )
+        return "\n".join(lines)
+    
+    def export(self, path):
+        import json
+        with open(path, "w") as f:
+            json.dump(self.as_dict(), f, indent=2, sort_keys=True)
+
+def processFilelog(h, compact=False):
     if "depotFile" in h:
-        df = DepotFile( h[ "depotFile" ] )
+        if compact:
+            df = CompactDepotFile( h[ "depotFile" ] )
+            shared = lambda x: _intern(x) if isinstance(x, str) else x
+        else:
+            df = DepotFile( h[ "depotFile" ] )
+            shared = lambda x: x
         for n, rev in enumerate( h[ "rev" ]):
             # Create a new revision of this file ready for populating
             r = df.new_revision()
             # Populate the base attributes of each revision
             r.rev = int( rev )
             r.change = int( h[ "change" ][ n ] )
-            r.action = h[ "action" ][ n ]
-            r.type = h[ "type" ][ n ]
-            r.time = datetime.datetime.utcfromtimestamp( int( h[ "time" ][ n ]) )
-            r.user = h[ "user" ][ n ]
-            r.client = h[ "client" ][ n ]
+            r.action = shared( h[ "action" ][ n ] )
+            r.type = shared( h[ "type" ][ n ] )
+            if compact:
+                r.time = int( h[ "time" ][ n ] ) # converted when read
+            else:
+                r.time = datetime.datetime.utcfromtimestamp( int( h[ "time" ][ n ]) )
+            r.user = shared( h[ "user" ][ n ] )
+            r.client = shared( h[ "client" ][ n ] )
             r.desc = h[ "desc" ][ n ]
             if "digest" in h and n < len(h[ "digest" ]):
                 r.digest = h[ "digest" ][ n ]
@@ -391,11 +724,12 @@ def processFilelog(h):
         raise Exception("Not a filelog object: " + h)
 
 class FilelogOutputHandler(OutputHandler):
-    def __init__(self):
+    def __init__(self, compact=False):
         OutputHandler.__init__(self)
+        self.compact = compact
     
     def outputStat(self, h):
-        df = processFilelog(h)
+        df = processFilelog(h, self.compact)
         
         return self.outputFilelog(df)
     
@@ -484,6 +818,35 @@ class P4(P4API.P4Adapter):
         'servers'   :   ('server', 'Name')
     }
     
+    # Commands taking more than arg_batch_size file arguments are run in
+    # batches and the results are joined. Set to 0 to disable.
+    # Only warnings, errors and messages of the last batch are kept.
+    
+    arg_batch_size = 5000
+    
+    # commands that may be split => flags that take a separate value
+    # (per `p4 help`; combined flags such as fstat -Ol need no entry)
+    
+    batch_commands = {
+        'add'       :   ('-c', '-t'),
+        'delete'    :   ('-c',),
+        'edit'      :   ('-c', '-t'),
+        'files'     :   ('-m',),
+        'filelog'   :   ('-c', '-m'),
+        'fstat'     :   ('-c', '-e', '-F', '-m', '-T', '-A'),
+        'have'      :   (),
+        'lock'      :   ('-c',),
+        'opened'    :   ('-c', '-C', '-m', '-u'),
+        'print'     :   ('-m', '-o'),
+        'reconcile' :   ('-c',),
+        'reopen'    :   ('-c', '-t'),
+        'revert'    :   ('-c', '-C'),
+        'sizes'     :   ('-b', '-m'),
+        'sync'      :   ('-m',),
+        'unlock'    :   ('-c', '-s'),
+        'where'     :   ()
+    }
+    
     def __init__(self, *args, **kwlist):
         P4API.P4Adapter.__init__(self, *args, **kwlist)
     
@@ -542,18 +905,51 @@ class P4(P4API.P4Adapter):
         return result[0]
     
     def __iterate(self, cmd, *args, **kargs):
+        # prefetch=N fetches up to N specs ahead on 'threads' pooled connections
+        # (a P4Pool can be passed as pool), the specs are still yielded in order
+        prefetch = kargs.pop("prefetch", 0)
+        threads = kargs.pop("threads", 8)
+        pool = kargs.pop("pool", None)
         
         if cmd in self.specfields:
             specs = self.run(cmd, *args, **kargs)
             spec = self.specfields[cmd][0]
             field = self.specfields[cmd][1]
             
+            if prefetch and asyncio is not None:
+                return self.__prefetch(spec, [ x[field] for x in specs ], prefetch, threads, pool)
+            
             # Return a generators (Python iterator object)
             # On iteration, this will retrieve one spec at a time
             return ( self.run(spec, '-o', x[field])[0] for x in specs )
         else:
             raise Exception('Unknown spec list command: %s', cmd)
     
+    def __prefetch(self, spec, names, window, threads, pool):
+        owned = pool is None
+        if owned:
+            pool = P4Pool(self, size=max(1, min(threads, window, len(names))))
+        executor = concurrent.futures.ThreadPoolExecutor(pool.size)
+        
+        def fetch(name):
+            with pool.lease() as p4:
+                return p4.run(spec, '-o', name)[0]
+        
+        names = iter(names)
+        pending = collections.deque( executor.submit(fetch, n) for n in itertools.islice(names, window) )
+        try:
+            while pending:
+                result = pending.popleft().result()
+                for n in itertools.islice(names, 1):
+                    pending.append(executor.submit(fetch, n))
+                yield result
+        finally:
+            for f in pending:
+                f.cancel()
+            executor.shutdown(True)
+            if owned:
+                pool.close()
+    
     def __repr__(self):
         state = "disconnected"
         if self.connected():
@@ -576,44 +972,81 @@ class P4(P4API.P4Adapter):
                 self.logger.info(message)
     
         
+    def enable_stats(self, stats=None, count_bytes=False):
+        """Start recording per-command timings into stats (a new P4Stats by default)"""
+        if stats is None:
+            stats = P4Stats(count_bytes)
+        self.__dict__["_stats"] = stats
+        return stats
+    
+    def disable_stats(self):
+        self.__dict__.pop("_stats", None)
+    
+    def stats_collector(self):
+        """The P4Stats this object records into, or None"""
+        return self.__dict__.get("_stats")
+    
+    def stats(self):
+        """Per-command timings as a dict, empty unless enable_stats() was called"""
+        collector = self.stats_collector()
+        if collector is None:
+            return {}
+        return collector.as_dict()
+    
     def run(self, *args, **kargs):
         "Generic run method"
-        context = {}
+        collector = self.__dict__.get("_stats")
+        if collector is not None:
+            start = _clock()
+        
         resultLogging = True
         
         if "resultLogging" in kargs:
             resultLogging= False
             del kargs["resultLogging"]
         
-        for (k,v) in list(kargs.items()):
-            context[k] = getattr(self, k)
-            setattr(self, k, v)
-                
+        context = {}
+        if kargs:
+            for (k,v) in list(kargs.items()):
+                context[k] = getattr(self, k)
+                setattr(self, k, v)
+        
         flatArgs = self.__flatten(args)
         
         # if encoding is set, translate to Bytes
-        if hasattr(self,"encoding") and self.encoding and not self.encoding == 'raw':
-            result = []
-            for s in flatArgs:
-                if isinstance(s, str):
-                    result.append( s.encode(self.encoding) )
-                else:
-                    result.append(s)
-            flatArgs = result
+        encoding = self.encoding if hasattr(self,"encoding") else None
+        if encoding and not encoding == 'raw':
+            flatArgs = [ s.encode(encoding) if isinstance(s, str) else s for s in flatArgs ]
         
         if self.logger:
             self.logger.info("p4 " + " ".join(flatArgs))
         
+        batches = self.__batches(flatArgs)
+        roundTrips = len(batches) if batches else 1
         try:
-            result = P4API.P4Adapter.run(self, *flatArgs)
+            if batches is None:
+                result = P4API.P4Adapter.run(self, *flatArgs)
+            else:
+                result = []
+                for batch in batches:
+                    result.extend(P4API.P4Adapter.run(self, *batch))
+                    if self.logger:
+                        self.log_messages()
         except P4Exception as e:
+            if collector is not None:
+                collector.record(self.__command_name(flatArgs), _clock() - start,
+                                 round_trips=roundTrips, failed=True)
             if self.logger:
                 self.log_messages()
             for (k,v) in list(context.items()):
                 setattr( self, k, v)
             raise e
         
-        if self.logger:
+        if collector is not None:
+            (count, size) = collector.measure(result)
+            collector.record(self.__command_name(flatArgs), _clock() - start, count, size, roundTrips)
+        
+        if self.logger and batches is None:
             self.log_messages()
         
         if resultLogging and self.logger:
@@ -624,6 +1057,47 @@ class P4(P4API.P4Adapter):
                     
         return result
     
+    def stream(self, *args, **kargs):
+        """Generator version of run(): yields each record as the server sends it.
+            
+            At most 'window' records (default 1000) are buffered, the command runs
+            on a helper thread while the caller consumes them. Breaking out of the
+            loop cancels the command. Errors are raised once all records have
+            been yielded. The P4 object must not be used for anything else until
+            the generator is exhausted or closed.
+            """
+        window = kargs.pop("window", 1000)
+        records = queue.Queue(window)
+        cancelled = threading.Event()
+        finished = object()
+        failure = []
+        handler = StreamingOutputHandler(records, cancelled)
+        
+        def produce():
+            try:
+                with self.using_handler(handler):
+                    self.run(*args, **kargs)
+            except Exception as e:
+                failure.append(e)
+            finally:
+                handler.put(finished)
+        
+        producer = threading.Thread(target=produce, name="P4.stream")
+        producer.daemon = True
+        producer.start()
+        try:
+            while True:
+                record = records.get()
+                if record is finished:
+                    break
+                yield record
+        finally:
+            cancelled.set()
+            producer.join()
+        
+        if failure:
+            raise failure[0]
+    
     def run_submit(self, *args, **kargs):
         "Simplified submit - if any arguments is a dict, assume it to be the changeform"
         nargs = list(args)
@@ -688,7 +1162,11 @@ class P4(P4API.P4Adapter):
     # Requires tagged output to be of any real use. If tagged output it not
     # enabled then you just get the raw data back
     #
+    # Pass compact=True to get CompactDepotFile objects, which use a
+    # fraction of the memory for long histories
+    #
     def run_filelog( self, *args, **kargs ):
+        compact = kargs.pop("compact", False)
         kargs["resultLogging"] = False
         raw = self.run( 'filelog', args, **kargs )
         if (not self.tagged or not raw):
@@ -699,7 +1177,7 @@ class P4(P4API.P4Adapter):
         for h in raw:
             df = None
             if isinstance( h, dict ):
-                df = processFilelog( h )
+                df = processFilelog( h, compact )
             else:
                 df = h
             result.append( df )
@@ -729,28 +1207,123 @@ class P4(P4API.P4Adapter):
         result = []
         if raw:
             debugResult = []
+            chunks = None
             for line in raw:
                 if isinstance(line, dict):
+                    if chunks is not None:
+                        result.append(self.__join_chunks(chunks))
                     result.append(line)
                     if logger:
                         debugResult.append(line)
-                    result.append("")
+                    chunks = []
                 else:
-                    # to support encoding for Python 3, we have to do a little dance
-                    # we cannot add bytes to the str "", but we expect that all lines
-                    # are either str or bytes. So if we encounter bytes, we replace the content
-                    try:
-                        result[-1] += line
-                    except TypeError:
-                        if type(line) == bytes and type(result[-1]) == str and result[-1] == "":
-                            result[-1] = line
-                        else:
-                            raise
+                    # collect the chunks of each file and join them once, repeated
+                    # concatenation is quadratic for large files
+                    if chunks is None:
+                        chunks = []
+                    chunks.append(line)
+            if chunks is not None:
+                result.append(self.__join_chunks(chunks))
             if logger:
                 logger.debug(debugResult)
             return result
         else:
             return []
+    
+    def __join_chunks(self, chunks):
+        # to support encoding for Python 3, we have to do a little dance
+        # all chunks of a file are expected to be either str or bytes
+        if not chunks:
+            return ""
+        if all(isinstance(c, bytes) for c in chunks):
+            return b"".join(chunks)
+        return "".join(chunks)
+    
+    def run_print_to(self, target, *args, **kargs):
+        """Print file contents straight into target instead of building strings.
+            
+            target can be:
+            A path to a directory: each file is written below it at its depot path
+            (without the leading //).
+            Any other path: the contents of all files are written to that file.
+            A bytearray: contents are appended to it.
+            A writable object (binary or text): contents are written to it.
+            A callable: called with each file's tagged dict, it returns one of the above.
+            
+            Chunks are written as they arrive, so memory use does not depend on file size.
+            Returns the list of tagged dicts, one per file printed.
+            """
+        encoding = self.encoding if getattr(self, "encoding", None) and self.encoding != 'raw' else "utf8"
+        shared = {}
+        
+        def sink_for(h, target):
+            if callable(target) and not hasattr(target, "write"):
+                return sink_for(h, target(h))
+            if isinstance(target, str):
+                if os.path.isdir(target):
+                    path = os.path.join(target, *h["depotFile"].lstrip("/").split("/"))
+                    if not os.path.isdir(os.path.dirname(path)):
+                        try:
+                            os.makedirs(os.path.dirname(path))
+                        except OSError:
+                            # another print job may have created it meanwhile
+                            if not os.path.isdir(os.path.dirname(path)):
+                                raise
+                    return (open(path, "wb"), True)
+                if target not in shared:
+                    shared[target] = open(target, "wb")
+                return (shared[target], False)
+            return (target, False)
+        
+        handler = PrintOutputHandler(lambda h: sink_for(h, target), encoding)
+        try:
+            with self.using_handler(handler):
+                self.run('print', args, resultLogging=False, **kargs)
+        finally:
+            handler.close()
+            for f in shared.values():
+                f.close()
+        return handler.files
+    
+    def run_print_parallel(self, jobs, threads=4):
+        """Run several run_print_to() calls at once on separate connections.
+            
+            jobs is a list of (target, file-arguments) pairs. Each worker thread uses
+            its own connection from new_connection(). Returns the tagged dicts of
+            every job, in the order of jobs.
+            """
+        jobs = list(jobs)
+        results = [None] * len(jobs)
+        failures = []
+        pending = queue.Queue()
+        for n, job in enumerate(jobs):
+            pending.put((n, job))
+        
+        def work():
+            connection = None
+            try:
+                connection = self.new_connection()
+                while True:
+                    try:
+                        (n, (target, fileArgs)) = pending.get_nowait()
+                    except queue.Empty:
+                        return
+                    results[n] = connection.run_print_to(target, fileArgs)
+            except Exception as e:
+                failures.append(e)
+            finally:
+                if connection is not None and connection.connected():
+                    connection.disconnect()
+        
+        workers = [ threading.Thread(target=work, name="P4.print") for i in range(max(1, min(threads, len(jobs)))) ]
+        for w in workers:
+            w.daemon = True
+            w.start()
+        for w in workers:
+            w.join()
+        if failures:
+            raise failures[0]
+        return results
 
     def run_resolve(self, *args, **kargs):
         if self.resolver:
@@ -783,14 +1356,56 @@ class P4(P4API.P4Adapter):
     def run_clone(self, *args, **kargs):
         raise Exception("Please run P4.clone) instead")
     
+    def __command_name(self, flatArgs):
+        if not flatArgs:
+            return ""
+        cmd = flatArgs[0]
+        if isinstance(cmd, bytes):
+            cmd = cmd.decode("utf8", "replace")
+        return cmd
+    
     def __flatten(self, args):
+        # iterative, large file lists are flattened in one pass without
+        # building intermediate tuples
+        if not any(isinstance(i, (tuple, list)) for i in args):
+            return list(args)
         result = []
-        if isinstance(args, tuple) or isinstance(args, list):
-            for i in args:
-                result.extend(self.__flatten(i))
-        else:
-            result.append(args)
-        return tuple(result)
+        stack = [iter(args)]
+        while stack:
+            for i in stack[-1]:
+                if isinstance(i, (tuple, list)):
+                    stack.append(iter(i))
+                    break
+                result.append(i)
+            else:
+                stack.pop()
+        return result
+    
+    def __batches(self, flatArgs):
+        """Splits the file arguments of a command into batches of arg_batch_size.
+            Returns None if the command does not need to be split."""
+        size = self.arg_batch_size
+        if not size or len(flatArgs) <= size + 1:
+            return None
+        cmd = self.__command_name(flatArgs)
+        if cmd not in self.batch_commands:
+            return None
+        valueFlags = self.batch_commands[cmd]
+        n = 1
+        while n < len(flatArgs):
+            arg = flatArgs[n]
+            if isinstance(arg, bytes):
+                arg = arg.decode("utf8", "replace")
+            if arg == "--":
+                n += 1
+                break
+            if not arg.startswith("-") or arg == "-":
+                break
+            n += 2 if arg in valueFlags else 1
+        (options, files) = (flatArgs[:n], flatArgs[n:])
+        if len(files) <= size:
+            return None
+        return [ options + files[i:i + size] for i in range(0, len(files), size) ]
 
     def __enter__( self ):
         return self
@@ -804,6 +1419,27 @@ class P4(P4API.P4Adapter):
         P4API.P4Adapter.connect( self )
         return self
     
+    # settings carried over by new_connection()
+    connection_settings = ("port", "user", "client", "password", "charset", "host", "prog",
+                           "version", "ticket_file", "cwd", "exception_level", "tagged", "encoding")
+    
+    def new_connection( self ):
+        """Returns a new, connected P4 object with the same settings as this one.
+            
+            A P4 object must only be used by one thread at a time; use this to give
+            each worker thread its own connection. The login ticket is shared.
+            """
+        other = P4()
+        for attr in self.connection_settings:
+            try:
+                setattr( other, attr, getattr(self, attr) )
+            except AttributeError:
+                pass # not supported by this API version, or read-only
+        collector = self.stats_collector()
+        if collector is not None:
+            other.enable_stats(collector)
+        return other.connect()
+    
     def is_ignored( self, path ):
         return P4API.P4Adapter.is_ignored( self, os.path.abspath(path) )
     
@@ -947,6 +1583,292 @@ class Map(P4API.P4Map):
             P4API.P4Map.insert(self, left, right )
 
 
+#
+# P4Pool - thread-safe pool of connected P4 objects
+#
+# A P4 object carries per-call state (client, cwd, handler, tagged, input ...)
+# and must only be used by one thread at a time. The pool leases each
+# connection to one caller and restores its context when it comes back.
+#
+
+class P4Pool(object):
+    """Thread-safe pool of connected, logged in P4 objects
+        
+        p4 is the P4 object whose settings the connections copy, a new P4
+        (environment settings) is used if omitted. At most 'size' connections
+        exist at any time, callers wait for a free one. Connections idle for
+        longer than idle_timeout seconds are disconnected.
+        
+            pool = P4Pool(size=4)
+            with pool.lease() as p4:
+                p4.run_fstat(path)
+        """
+    
+    def __init__(self, p4=None, size=8, idle_timeout=300, login=True):
+        self.template = p4 if p4 is not None else P4()
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.login = login
+        self.idle = []      # (p4, released at), most recently used last
+        self.total = 0
+        self.closed = False
+        self.condition = threading.Condition()
+    
+    def acquire(self, timeout=None):
+        """Returns a connected P4 object, waiting up to timeout seconds
+            (forever if None) for one to become free"""
+        deadline = None if timeout is None else _clock() + timeout
+        p4 = None
+        with self.condition:
+            expired = self.__expire()
+            while True:
+                if self.closed:
+                    raise P4Exception("P4Pool is closed")
+                if self.idle:
+                    p4 = self.idle.pop()[0]
+                    break
+                if self.total < self.size:
+                    self.total += 1
+                    break
+                remaining = None if deadline is None else deadline - _clock()
+                if remaining is not None and remaining <= 0:
+                    raise P4Exception("P4Pool: no connection available after %s seconds" % timeout)
+                self.condition.wait(remaining)
+        for old in expired:
+            self.__disconnect(old)
+        
+        try:
+            if p4 is None or not p4.connected():
+                p4 = self.__connect()
+        except Exception:
+            with self.condition:
+                self.total -= 1
+                self.condition.notify()
+            raise
+        p4.__dict__["_pool_context"] = self.__context(p4)
+        return p4
+    
+    def release(self, p4, broken=False):
+        """Returns a leased connection, its context is reset to what it was when leased.
+            Broken or disconnected connections are dropped from the pool."""
+        context = p4.__dict__.pop("_pool_context", {})
+        for (k,v) in list(context.items()):
+            try:
+                setattr( p4, k, v )
+            except AttributeError:
+                pass # read-only attribute
+        if not broken:
+            dropped = getattr(p4, "dropped", None)
+            broken = not p4.connected() or (dropped is not None and dropped())
+        with self.condition:
+            if broken or self.closed:
+                self.total -= 1
+            else:
+                self.idle.append((p4, _clock()))
+            self.condition.notify()
+        if broken or self.closed:
+            self.__disconnect(p4)
+    
+    @contextmanager
+    def lease(self, timeout=None):
+        """Leases a connection for the duration of the block"""
+        p4 = self.acquire(timeout)
+        broken = False
+        try:
+            yield p4
+        except P4Exception:
+            dropped = getattr(p4, "dropped", None)
+            broken = not p4.connected() or (dropped is not None and dropped())
+            raise
+        finally:
+            self.release(p4, broken)
+    
+    def close(self):
+        """Disconnects the idle connections, leased ones are disconnected when released"""
+        with self.condition:
+            self.closed = True
+            idle = [ p4 for (p4, released) in self.idle ]
+            self.total -= len(idle)
+            self.idle = []
+            self.condition.notify_all()
+        for p4 in idle:
+            self.__disconnect(p4)
+    
+    def __connect(self):
+        p4 = self.template.new_connection()
+        if self.login:
+            try:
+                with p4.at_exception_level(P4.RAISE_ERROR):
+                    p4.run_login("-s")
+            except P4Exception:
+                p4.run_login()
+        return p4
+    
+    def __context(self, p4):
+        context = {}
+        for attr in p4.__members__:
+            if attr not in ("port", "track", "server_level", "p4config_file"):
+                try:
+                    context[attr] = getattr(p4, attr)
+                except AttributeError:
+                    pass
+        return context
+    
+    def __expire(self):
+        # called with the condition held, returns the connections to disconnect
+        if not self.idle_timeout:
+            return []
+        limit = _clock() - self.idle_timeout
+        expired = [ p4 for (p4, released) in self.idle if released < limit ]
+        if expired:
+            self.idle = [ (p4, released) for (p4, released) in self.idle if released >= limit ]
+            self.total -= len(expired)
+        return expired
+    
+    def __disconnect(self, p4):
+        try:
+            if p4.connected():
+                p4.disconnect()
+        except P4Exception:
+            pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+
+#
+# AsyncP4 - asyncio interface to P4
+#
+# Commands run on a pool of worker threads, each command leasing a
+# connection from a P4Pool. The methods return awaitables, independent
+# queries can be overlapped with asyncio.gather().
+#
+
+class AsyncP4(object):
+    """asyncio facade over P4
+        
+        p4 is the P4 object whose settings the connections copy, a new P4
+        (environment settings) is used if omitted. At most 'concurrency'
+        commands run at the same time. Pass pool to share a P4Pool with
+        other code.
+        
+            async with AsyncP4(concurrency=8) as p4:
+                shots = await asyncio.gather(*[ p4.run_fstat(s) for s in shots ])
+                async for client in p4.iterate_clients("-u", user):
+                    ...
+        """
+    
+    def __init__(self, p4=None, concurrency=8, pool=None):
+        if asyncio is None:
+            raise P4Exception("AsyncP4 requires Python 3")
+        self.owns_pool = pool is None
+        self.pool = pool if pool is not None else P4Pool(p4, size=concurrency)
+        self.concurrency = concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    
+    def __getattr__(self, name):
+        if name.startswith("iterate_"):
+            return lambda *args, **kargs: AsyncP4Iterator(self, name, args, kargs)
+        elif name.startswith(("run_", "fetch_", "save_", "delete_")):
+            return lambda *args, **kargs: self.submit(lambda p4: getattr(p4, name)(*args, **kargs))
+        else:
+            raise AttributeError(name)
+    
+    def run(self, *args, **kargs):
+        "Generic run method, returns an awaitable for the result of P4.run()"
+        return self.submit(lambda p4: p4.run(*args, **kargs))
+    
+    def submit(self, fn):
+        """Calls fn(p4) on a worker thread with a leased connection.
+            Returns an awaitable for the result."""
+        def call():
+            with self.pool.lease() as p4:
+                return fn(p4)
+        return asyncio.wrap_future(self.executor.submit(call))
+    
+    def close(self):
+        """Waits for running commands and closes the pool unless it was passed in"""
+        self.executor.shutdown(True)
+        if self.owns_pool:
+            self.pool.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+        return False
+    
+    def __aenter__(self):
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(self)
+        return future
+    
+    def __aexit__(self, exc_type, exc_val, exc_tb):
+        return asyncio.get_event_loop().run_in_executor(None, self.close)
+
+class AsyncP4Iterator(object):
+    """Async iterator returned by the AsyncP4.iterate_* methods.
+        The connection is leased until the iteration ends or close() is called."""
+    
+    finished = object()
+    
+    def __init__(self, owner, name, args, kargs):
+        self.owner = owner
+        self.name = name
+        self.args = args
+        self.kargs = kargs
+        self.p4 = None
+        self.iterator = None
+    
+    def __aiter__(self):
+        return self
+    
+    def __anext__(self):
+        future = asyncio.get_event_loop().create_future()
+        
+        def done(f):
+            if future.cancelled():
+                return
+            if f.cancelled():
+                future.cancel()
+            elif f.exception() is not None:
+                future.set_exception(f.exception())
+            elif f.result() is self.finished:
+                future.set_exception(StopAsyncIteration())
+            else:
+                future.set_result(f.result())
+        
+        # steps run on the loop's default executor, a step waiting for a lease
+        # must not hold up the command workers that would return one
+        asyncio.get_event_loop().run_in_executor(None, self.next).add_done_callback(done)
+        return future
+    
+    def next(self):
+        if self.iterator is None:
+            self.p4 = self.owner.pool.acquire()
+            self.iterator = getattr(self.p4, self.name)(*self.args, **self.kargs)
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.close()
+            return self.finished
+        except Exception:
+            self.close()
+            raise
+    
+    def close(self):
+        if self.p4 is not None:
+            self.owner.pool.release(self.p4)
+            self.p4 = None
+        self.iterator = iter(())
+    
+    def aclose(self):
+        return asyncio.get_event_loop().run_in_executor(None, self.close)
+
 def init(*args, **kargs):  
     keywords = ("user", "client", "directory", "port", "casesensitive", "unicode")
     
@@ -8,16 +8,32 @@ from zipfile import ZipFile
 from urllib.request import urlopen
 import tempfile
 import shutil
+import re
+import fnmatch
+import stat
+import select
+import struct
+import ctypes
+import ctypes.util
+import time
+import threading
+import queue
+import sqlite3
+import json
+import hashlib
+import mmap
+import concurrent.futures
 
 import maya.OpenMaya as OpenMaya
 import maya.OpenMayaMPx as OpenMayaMPx
 import maya.mel as mel
+import maya.utils
 from maya import cmds
 
 pluginDir = os.path.dirname(inspect.getsourcefile(lambda: None))
 
 sys.path.append(pluginDir + '/P4Library/') #Points Maya to the location of the P4 Library
-from P4 import P4,P4Exception
+from P4 import P4,P4Exception,Progress,Map
 
 ARCHIVE_URL = 'https://github.com/BrianRoyston/P4UCB/archive/refs/heads/main.zip'
 INITIAL_CONFIG = {
@@ -25,6 +41,12 @@ INITIAL_CONFIG = {
     'user': '',
     'password': '',
     'client': '',
+    'sync_scope': 'full',
+    'skip_unchanged': 'true',
+    'autosave_shelve': 'false',
+    'autosave_interval': '600',
+    'watch_workspace': 'false',
+    'performance_stats': 'true',
 }
 
 
@@ -36,11 +58,16 @@ def callback(event):
     """Decorator that registers a function as a callback, handling errors."""
     def f(func):
         def wrapped_func(*args):
+            start = time.time()
             try:
                 return func(*args)
             except Exception as e:
                 cmds.confirmDialog(title='P4UCB Error', icon='critical',
                                    message=str(e), button=["ok"])
+            finally:
+                collector = statsCollector()
+                if collector is not None:
+                    collector.record('callback:' + func.__name__, time.time() - start, round_trips=0)
         callbacks[event] = wrapped_func
         return func
     return f
@@ -54,32 +81,350 @@ def readP4Config():
 
 config = readP4Config()
 p4 = P4()
+if config.getboolean('performance_stats', fallback=True) and hasattr(p4, 'enable_stats'):
+    p4.enable_stats()
 
-def isFileOpened(filepath):
-    openedFiles = p4.run("opened")
-    for fileInfo in openedFiles:
-        if (fileInfo['depotFile'] == filepath):
+def statsCollector():
+    """The shared stats collector, None if disabled or if P4Library/P4.py predates it."""
+    return p4.stats_collector() if hasattr(p4, 'stats_collector') else None
+
+
+class OpenedFilesIndex:
+    """Client-side index of the files opened in this workspace, keyed by depotFile.
+
+    Populated from a single `p4 opened` and kept current by the plug-in's own
+    edit/add/revert/submit calls. It is re-read from the server once it is older
+    than `opened_cache_ttl` seconds (config.txt) to pick up changes made outside Maya.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.lastRefresh = None
+
+    def invalidate(self):
+        self.lastRefresh = None
+
+    def isStale(self):
+        if self.lastRefresh is None:
             return True
-    return False
+        ttl = config.getfloat('opened_cache_ttl', fallback=60)
+        return time.time() - self.lastRefresh > ttl
+
+    def refresh(self, force=False):
+        if force or self.isStale():
+            connectionManager.ensureConnected()
+            # "File(s) not opened" is only a warning, an empty list is the answer
+            with p4.at_exception_level(P4.RAISE_ERROR):
+                openedFiles = p4.run("opened")
+            self.files = {fileInfo['depotFile']: fileInfo for fileInfo in openedFiles
+                          if isinstance(fileInfo, dict)}
+            self.lastRefresh = time.time()
+        return self.files
+
+    def contains(self, depotFile):
+        return depotFile in self.refresh()
+
+    def depotFiles(self):
+        return list(self.refresh())
+
+    def markOpened(self, results):
+        """Record the tagged output of an edit/add/etc. without asking the server again."""
+        for fileInfo in results:
+            if isinstance(fileInfo, dict) and 'depotFile' in fileInfo:
+                self.files[fileInfo['depotFile']] = fileInfo
+
+    def markClosed(self, depotFiles):
+        for depotFile in depotFiles:
+            self.files.pop(depotFile, None)
+
+openedIndex = OpenedFilesIndex()
+
+def isFileOpened(filepath):
+    return openedIndex.contains(filepath)
 
 def getOpenedList():
-    openedFiles = p4.run("opened")
-    return list(map(lambda fileInfo : fileInfo['depotFile'], openedFiles))
+    return openedIndex.depotFiles()
+
+
+DELETE_ACTIONS = ('delete', 'move/delete')
+
+class FileStateCache:
+    """Local cache of `p4 fstat` state (headRev, headAction, action) keyed by depot path.
+
+    Files not in the depot are cached too, with a headRev of None. Entries are
+    dropped by the plug-in's own operations, and at most every `fstat_poll_interval`
+    seconds (config.txt) one `p4 changes -m1` checks for new submits, invalidating
+    only the files they touched. With `fstat_cache_db = true` the cache is also kept
+    in a SQLite file next to the plug-in so it survives restarts.
+    """
+
+    FIELDS = 'depotFile,headRev,headAction,action'
+
+    def __init__(self):
+        self.states = {}
+        self.lastChange = None
+        self.lastPoll = 0
+        self.db = None
+
+    def openStore(self):
+        if self.db is not None or not config.getboolean('fstat_cache_db', fallback=False):
+            return self.db
+        self.db = sqlite3.connect(os.path.join(pluginDir, 'fstat_cache.db'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS states (depotFile TEXT PRIMARY KEY, '
+                        'headRev INTEGER, headAction TEXT, action TEXT)')
+        meta = dict(self.db.execute('SELECT key, value FROM meta'))
+        if meta.get('server') != config['port'] + ' ' + config['client']:
+            self.db.execute('DELETE FROM states') # cached for another server or workspace
+            self.setMeta('server', config['port'] + ' ' + config['client'])
+        elif meta.get('lastChange'):
+            self.lastChange = int(meta['lastChange'])
+        self.db.commit()
+        return self.db
+
+    def setMeta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, str(value)))
+
+    def get(self, depotFile):
+        """The cached state of depotFile, asking the server only on a miss."""
+        self.poll()
+        state = self.states.get(depotFile)
+        if state is None and self.openStore():
+            row = self.db.execute('SELECT headRev, headAction, action FROM states WHERE depotFile = ?',
+                                  (depotFile,)).fetchone()
+            if row:
+                state = self.states[depotFile] = {'headRev': row[0], 'headAction': row[1], 'action': row[2]}
+        if state is None:
+            state = self.fetch(depotFile)
+        return state
+
+    def inDepot(self, depotFile):
+        """True if depotFile has a head revision that isn't deleted.
+
+        Files in a fresh have snapshot are answered from it without asking the server.
+        """
+        if haveSnapshot.haveRevision(depotFile):
+            return True
+        state = self.get(depotFile)
+        return state['headRev'] is not None and state['headAction'] not in DELETE_ACTIONS
+
+    def fetch(self, depotFile):
+        connectToP4()
+        with p4.at_exception_level(P4.RAISE_ERROR): # "no such file" means not in depot
+            result = p4.run("fstat", "-T", self.FIELDS, depotFile)
+        state = {'headRev': None, 'headAction': None, 'action': None}
+        for fileInfo in result:
+            if isinstance(fileInfo, dict):
+                state = {'headRev': int(fileInfo['headRev']) if 'headRev' in fileInfo else None,
+                         'headAction': fileInfo.get('headAction'),
+                         'action': fileInfo.get('action')}
+        self.states[depotFile] = state
+        if self.openStore():
+            self.db.execute('INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?)',
+                            (depotFile, state['headRev'], state['headAction'], state['action']))
+            self.db.commit()
+        return state
+
+    def invalidate(self, depotFiles):
+        depotFiles = list(depotFiles)
+        for depotFile in depotFiles:
+            self.states.pop(depotFile, None)
+        if depotFiles and self.openStore():
+            self.db.executemany('DELETE FROM states WHERE depotFile = ?', [(depotFile,) for depotFile in depotFiles])
+            self.db.commit()
+
+    def clear(self):
+        self.states = {}
+        self.lastChange = None
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def poll(self):
+        """Invalidate files touched by changes submitted since the last poll."""
+        now = time.time()
+        if now - self.lastPoll < config.getfloat('fstat_poll_interval', fallback=60):
+            return
+        self.lastPoll = now
+        self.openStore()
+        connectToP4()
+
+        clientView = '//' + config['client'] + '/...'
+        with p4.at_exception_level(P4.RAISE_ERROR):
+            changes = p4.run("changes", "-m1", "-s", "submitted", clientView)
+            newest = int(changes[0]['change']) if changes else 0
+            if self.lastChange is not None and newest > self.lastChange:
+                changedFiles = p4.run("files", "{}@{},@now".format(clientView, self.lastChange + 1))
+                self.invalidate(fileInfo['depotFile'] for fileInfo in changedFiles if isinstance(fileInfo, dict))
+        self.lastChange = newest
+        if self.db is not None:
+            self.setMeta('lastChange', newest)
+            self.db.commit()
+
+fileStates = FileStateCache()
+
+def applyConfig(connection):
+    connection.port = config['port']
+    connection.user = config['user']
+    connection.password = config['password']
+    connection.client = config['client']
+
+
+def loginIfNeeded(connection):
+    """Log in with the password only when the server doesn't accept the current ticket."""
+    try:
+        with connection.at_exception_level(P4.RAISE_ERROR):
+            connection.run("login", "-s")
+    except P4Exception as e:
+        if isConnectionError(e):
+            raise
+        connection.run_login() # no ticket, or it expired
 
-def connectToP4():
-    if (not p4.connected()):
-        config = readP4Config()
-        p4.port = config['port']
-        p4.user = config['user']
-        p4.password = config['password']
-        p4.client = config['client']
+
+CONNECTION_ERRORS = ('tcp', 'ssl receive', 'ssl send', 'connect to server failed', 'partner exited', 'rpctransport')
+
+def isConnectionError(e):
+    message = str(e).lower()
+    return any(text in message for text in CONNECTION_ERRORS)
+
+
+class ConnectionManager:
+    """Keeps the plug-in's P4 connection warm.
+
+    The connection is made from the config loaded at startup (reloaded only when the
+    setup window saves), reuses an existing login ticket instead of sending the
+    password, reconnects with exponential backoff when the socket has dropped, and
+    a keepalive (`keepalive_interval` seconds in config.txt, 0 to disable) runs
+    `p4 login -s` on the main thread when Maya is idle so the session and ticket
+    stay valid between scene events.
+    """
+
+    RECONNECT_DELAY = 0.5 # seconds, doubled after every failed attempt
+
+    def __init__(self, connection):
+        self.p4 = connection
+        self.keepaliveThread = None
+        self.stopping = threading.Event()
+
+    def ensureConnected(self):
+        if (not self.p4.connected()):
+            self.reconnect()
+        return self.p4
+
+    def reconnect(self):
+        attempts = config.getint('reconnect_attempts', fallback=4)
+        delay = self.RECONNECT_DELAY
+        for attempt in range(attempts):
+            try:
+                if self.p4.connected():
+                    self.p4.disconnect()
+                applyConfig(self.p4)
+                self.p4.connect()
+                loginIfNeeded(self.p4)
+                break
+            except P4Exception as e:
+                if (not isConnectionError(e)) or attempt == attempts - 1:
+                    raise
+                print("P4 connection failed, retrying in {}s".format(delay))
+                time.sleep(delay)
+                delay *= 2
+        self.startKeepalive()
+
+    def keepalive(self):
+        """Cheap round-trip that also detects dead sockets and expired tickets."""
+        if (not self.p4.connected()):
+            return # reconnected lazily on the next command
         try:
-            p4.connect()
-            p4.run_login()
-        except Exception as e:
-            cmds.confirmDialog(title='Cannot Connect to P4', icon='critical',
-                               message=str(e), button=["ok"])
-            raise e
+            self.p4.run("login", "-s")
+        except P4Exception as e:
+            if isConnectionError(e) or not self.p4.connected():
+                self.p4.disconnect()
+            else:
+                self.p4.run_login() # ticket expired
+
+    def keepaliveLoop(self, interval, stopping):
+        while not stopping.wait(interval):
+            maya.utils.executeDeferred(self.keepalive)
+
+    def startKeepalive(self):
+        interval = config.getfloat('keepalive_interval', fallback=300)
+        if interval <= 0 or (self.keepaliveThread and self.keepaliveThread.is_alive()):
+            return
+        self.stopping = threading.Event()
+        self.keepaliveThread = threading.Thread(target=self.keepaliveLoop, args=(interval, self.stopping),
+                                                name='P4UCB keepalive', daemon=True)
+        self.keepaliveThread.start()
+
+    def reset(self):
+        """Drop the connection so the next command reconnects with the current config."""
+        self.stopping.set()
+        if self.p4.connected():
+            self.p4.disconnect()
+
+connectionManager = ConnectionManager(p4)
+
+def connectToP4():
+    try:
+        connectionManager.ensureConnected()
+    except Exception as e:
+        cmds.confirmDialog(title='Cannot Connect to P4', icon='critical',
+                           message=str(e), button=["ok"])
+        raise e
+
+
+class ClientIndex:
+    """The workspace's View compiled into a P4 Map, for local <-> depot translation in process.
+
+    The client spec is fetched once, again only when the port or workspace in
+    config.txt changes or after invalidate().
+    """
+
+    def __init__(self):
+        self.viewMap = None
+        self.root = None
+        self.clientPrefix = None
+        self.key = None
+
+    def load(self):
+        key = (config['port'], config['client'])
+        if self.viewMap is None or self.key != key:
+            connectionManager.ensureConnected()
+            spec = p4.fetch_client()
+            self.viewMap = Map(list(spec._view))
+            self.root = spec._root.replace('\\', '/').rstrip('/')
+            self.clientPrefix = '//{}/'.format(spec._client)
+            self.key = key
+        return self.viewMap
+
+    def invalidate(self):
+        self.viewMap = None
+
+    def localToDepot(self, localPath):
+        """The depot path of localPath, or None if it is outside the root or the view."""
+        self.load()
+        path = localPath.replace('\\', '/')
+        root = self.root + '/'
+        if os.path.normcase(path[:len(root)]) != os.path.normcase(root):
+            return None
+        return self.viewMap.translate(self.clientPrefix + path[len(root):], Map.RIGHT2LEFT)
+
+    def depotToLocal(self, depotFile):
+        """The local path of depotFile, or None if the view does not map it."""
+        clientPath = self.load().translate(depotFile)
+        if clientPath is None:
+            return None
+        return self.root + '/' + clientPath[len(self.clientPrefix):]
+
+clientIndex = ClientIndex()
+
+def localToDepotPath(localPath):
+    """Map a local file path to its depot path, or None if it is outside the workspace
+    or the workspace view can't be read."""
+    try:
+        return clientIndex.localToDepot(localPath)
+    except P4Exception as e:
+        print("Warning: Cannot read the workspace view: " + str(e).strip())
+        return None
 
 
 def getRelativeFilePath():
@@ -88,33 +433,575 @@ def getRelativeFilePath():
         print("Warning: File not saved, cannot check perforce")
         return None
 
-    if (('/' + config['client'] + '/') not in maFile):
+    relativeFilePath = localToDepotPath(maFile)
+    if (not relativeFilePath):
         print("Warning: Workspace (" + config['client'] + ") was not found in file path")
+    return relativeFilePath
+
+
+# node type -> attribute holding an external cache path
+CACHE_ATTRIBUTES = {
+    'file': 'fileTextureName',
+    'AlembicNode': 'abc_File',
+    'gpuCache': 'cacheFileName',
+}
+
+def getSceneDependencies():
+    """Local paths of everything the open scene pulls in: itself, references, textures and caches."""
+    paths = set(cmds.file(q=True, list=True) or [])
+
+    # unloaded references are not part of the file list
+    for refNode in cmds.ls(type='reference') or []:
+        try:
+            paths.add(cmds.referenceQuery(refNode, filename=True, withoutCopyNumber=True))
+        except RuntimeError:
+            pass # sharedReferenceNode and friends have no file
+
+    nodeTypes = set(cmds.allNodeTypes() or [])
+    for nodeType, attribute in CACHE_ATTRIBUTES.items():
+        if nodeType not in nodeTypes:
+            continue # node type's plug-in isn't loaded
+        for node in cmds.ls(type=nodeType) or []:
+            path = cmds.getAttr(node + '.' + attribute)
+            if path:
+                paths.add(path)
+
+    # strip reference copy numbers and turn UDIM style tokens into p4 wildcards
+    return sorted(set(re.sub(r'<[^>]+>', '*', re.sub(r'\{\d+\}$', '', path)) for path in paths if path))
+
+
+def getSelectedFiles():
+    """Local paths behind the current selection: referenced files and texture/cache nodes."""
+    paths = set()
+    for node in cmds.ls(sl=True) or []:
+        nodeType = cmds.nodeType(node)
+        if nodeType == 'reference' or cmds.referenceQuery(node, isNodeReferenced=True):
+            try:
+                paths.add(cmds.referenceQuery(node, filename=True, withoutCopyNumber=True))
+            except RuntimeError:
+                pass # sharedReferenceNode and friends have no file
+        attribute = CACHE_ATTRIBUTES.get(nodeType)
+        if attribute:
+            path = cmds.getAttr(node + '.' + attribute)
+            if path:
+                paths.add(path)
+    return sorted(paths)
+
+
+def getSelectedDepotFiles():
+    depotFiles = sorted(set(filter(None, map(localToDepotPath, getSelectedFiles()))))
+    if (not depotFiles):
+        cmds.confirmDialog(title='Nothing Selected', message='Select references or texture/cache nodes inside the workspace', button=["ok"])
+    return depotFiles
+
+
+def chooseDirectory():
+    """Ask for a directory inside the workspace, returning its local path."""
+    result = cmds.fileDialog2(fileMode=3, caption='Choose a directory', dialogStyle=2)
+    if (not result):
         return None
-    extra, relativeFilePathLocal = maFile.split('/' + config['client'] + '/')
-    return '//Animation_Production/' + relativeFilePathLocal
+    if (not localToDepotPath(result[0] + '/')):
+        cmds.confirmDialog(title='Not in Workspace', icon='critical',
+                           message='{} is not inside the {} workspace'.format(result[0], config['client']), button=["ok"])
+        return None
+    return result[0]
 
 
-def p4GetLatest(*args, verbose=True):
-    print("p4GetLatest")
-    connectToP4()
-    filepath = getRelativeFilePath()
-    try:
-        changedFiles = p4.run_sync()
-        """for fileInfo in changedFiles:
+def syncScope():
+    """How much scene callbacks sync: 'full', 'scene' or 'scene+full' (config.txt sync_scope)."""
+    return config.get('sync_scope', fallback='full')
+
+
+def newP4Connection():
+    """Open a separate logged-in connection, for work done off Maya's main thread."""
+    newConnection = P4()
+    if statsCollector() is not None:
+        newConnection.enable_stats(statsCollector()) # one report for all connections
+    applyConfig(newConnection)
+    newConnection.connect()
+    loginIfNeeded(newConnection)
+    return newConnection
+
+
+class MayaProgress(Progress):
+    """Forwards P4 transfer progress to Maya's main progress bar.
+
+    P4 calls these hooks from whichever thread runs the command, so every UI
+    update is posted to the main thread with executeDeferred.
+    """
+
+    UPDATE_INTERVAL = 0.25 # seconds between progress bar redraws
+
+    def __init__(self, status):
+        Progress.__init__(self)
+        self.status = status
+        self.total = 0
+        self.lastUpdate = 0
+
+    def init(self, type):
+        Progress.init(self, type)
+        maya.utils.executeDeferred(self.begin)
+
+    def setTotal(self, total):
+        Progress.setTotal(self, total)
+        maya.utils.executeDeferred(self.redraw, 0, int(total))
+
+    def update(self, position):
+        Progress.update(self, position)
+        now = time.time()
+        if now - self.lastUpdate >= self.UPDATE_INTERVAL:
+            self.lastUpdate = now
+            maya.utils.executeDeferred(self.redraw, int(position), int(self.total or 0))
+
+    def done(self, fail):
+        Progress.done(self, fail)
+        maya.utils.executeDeferred(self.end)
+
+    @staticmethod
+    def progressBar():
+        return mel.eval("$tmp = $gMainProgressBar")
+
+    def begin(self):
+        cmds.progressBar(self.progressBar(), edit=True, beginProgress=True,
+                         isInterruptable=False, status=self.status, maxValue=100)
+
+    def redraw(self, position, total):
+        if total > 0:
+            cmds.progressBar(self.progressBar(), edit=True, maxValue=total, progress=min(position, total))
+
+    def end(self):
+        cmds.progressBar(self.progressBar(), edit=True, endProgress=True)
+
+
+def formatBytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} TB".format(size)
+
+
+class SyncPlan:
+    """What a sync would transfer, from `p4 sync -n` plus `p4 sizes` where needed.
+
+    Pending files and bytes are aggregated per depot directory so large directories
+    (typically sim caches) can be left out before anything is transferred.
+    """
+
+    def __init__(self, pendingFiles):
+        self.files = pendingFiles
+        self.skipped = {}
+        self.directories = {}
+        for fileInfo in pendingFiles:
+            directory = fileInfo['depotFile'].rsplit('/', 1)[0]
+            stats = self.directories.setdefault(directory, [0, 0])
+            stats[0] += 1
+            stats[1] += int(fileInfo.get('fileSize') or 0)
+
+    @property
+    def totalBytes(self):
+        return sum(stats[1] for stats in self.directories.values())
+
+    def skipLargeDirectories(self, maxBytes, patterns=()):
+        """Drop directories over maxBytes (that match one of patterns, if any are given)."""
+        if maxBytes <= 0:
+            return
+        for directory, stats in list(self.directories.items()):
+            if stats[1] <= maxBytes:
+                continue
+            if patterns and not any(fnmatch.fnmatch(directory + '/', pattern) for pattern in patterns):
+                continue
+            self.skipped[directory] = self.directories.pop(directory)
+        if self.skipped:
+            self.files = [fileInfo for fileInfo in self.files
+                          if fileInfo['depotFile'].rsplit('/', 1)[0] not in self.skipped]
+
+    def applyConfig(self):
+        """Apply the sync_skip_dir_bytes / sync_skip_patterns thresholds from config.txt."""
+        patterns = [pattern.strip() for pattern in config.get('sync_skip_patterns', fallback='').split(',') if pattern.strip()]
+        self.skipLargeDirectories(config.getint('sync_skip_dir_bytes', fallback=0), patterns)
+
+    def summary(self):
+        lines = ["{} files, {}".format(len(self.files), formatBytes(self.totalBytes))]
+        for directory, (count, size) in sorted(self.skipped.items()):
+            lines.append("Skipped {} ({} files, {})".format(directory, count, formatBytes(size)))
+        return lines
+
+
+def planSync(connection, fileArgs=()):
+    """Preview a sync without transferring anything."""
+    with connection.at_exception_level(P4.RAISE_ERROR):
+        pendingFiles = [fileInfo for fileInfo in connection.run_sync('-n', list(fileArgs)) if isinstance(fileInfo, dict)]
+
+        # older servers leave fileSize out of the preview, ask for just those files
+        unsized = ['{}#{}'.format(fileInfo['depotFile'], fileInfo['rev']) for fileInfo in pendingFiles
+                   if 'fileSize' not in fileInfo and fileInfo.get('action') != 'deleted']
+        if unsized:
+            sizes = {fileInfo['depotFile']: fileInfo.get('fileSize') for fileInfo in connection.run('sizes', unsized)
+                     if isinstance(fileInfo, dict)}
+            for fileInfo in pendingFiles:
+                if fileInfo['depotFile'] in sizes:
+                    fileInfo['fileSize'] = sizes[fileInfo['depotFile']]
+    return SyncPlan(pendingFiles)
+
+
+def parallelSyncSettings():
+    """Parallel sync tuning from config.txt; sync_parallel_threads <= 1 disables it."""
+    return {
+        'threads': config.getint('sync_parallel_threads', fallback=0),
+        'batch': config.getint('sync_parallel_batch', fallback=8),
+        'batchsize': config.getint('sync_parallel_batch_bytes', fallback=0),
+    }
+
+
+def syncRevisions(connection, revisions):
+    """Sync explicit file#rev lists, as produced by `p4 sync -n`."""
+    with connection.at_exception_level(P4.RAISE_ERROR):
+        return connection.run_sync(['{}#{}'.format(fileInfo['depotFile'], fileInfo['rev']) for fileInfo in revisions])
+
+
+def partitionBatches(pendingFiles, batch, batchsize):
+    """Split pending files into batches of at most `batch` files or `batchsize` bytes, largest files first."""
+    pendingFiles = sorted(pendingFiles, key=lambda fileInfo: -int(fileInfo.get('fileSize') or 0))
+    batches = []
+    current = []
+    currentBytes = 0
+    for fileInfo in pendingFiles:
+        size = int(fileInfo.get('fileSize') or 0)
+        if current and (len(current) >= batch or (batchsize and currentBytes + size > batchsize)):
+            batches.append(current)
+            current = []
+            currentBytes = 0
+        current.append(fileInfo)
+        currentBytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+class SyncPool:
+    """Client-side parallel sync over several P4 connections.
+
+    Used when the server cannot do `sync --parallel` itself: the pending file list is
+    cut into batches which a thread per connection syncs as explicit revisions.
+    """
+
+    def __init__(self):
+        self.connections = []
+
+    def resize(self, threads):
+        while len(self.connections) < threads:
+            self.connections.append(newP4Connection())
+        for connection in self.connections:
+            if (not connection.connected()):
+                applyConfig(connection)
+                connection.connect()
+                loginIfNeeded(connection)
+
+    def sync(self, pendingFiles, settings, progress=None):
+        batches = queue.Queue()
+        for batch in partitionBatches(pendingFiles, max(settings['batch'], 1), settings['batchsize']):
+            batches.put(batch)
+        self.resize(settings['threads'])
+
+        results = []
+        errors = []
+        lock = threading.Lock()
+        synced = [0]
+
+        def syncBatches(connection):
+            while True:
+                try:
+                    batch = batches.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    result = syncRevisions(connection, batch)
+                except Exception as e:
+                    with lock:
+                        errors.append(e)
+                    continue
+                with lock:
+                    results.extend(result)
+                    synced[0] += len(batch)
+                    if progress:
+                        progress.update(synced[0])
+
+        threads = [threading.Thread(target=syncBatches, args=(connection,), daemon=True)
+                   for connection in self.connections[:settings['threads']]]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            raise errors[0]
+        return results
+
+    def close(self):
+        for connection in self.connections:
+            if connection.connected():
+                connection.disconnect()
+        self.connections = []
+
+
+class SyncWorker:
+    """Runs syncs on a dedicated thread with its own P4 connection.
+
+    Jobs are queued from the main thread and completion is posted back to it with
+    executeDeferred, so scene callbacks return as soon as the sync is queued.
+    Identical pending jobs are coalesced.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connection = None
+        self.pool = SyncPool()
+        self.serverParallel = None # unknown until the first parallel sync
+
+    def isBusy(self):
+        with self.lock:
+            return len(self.pending) > 0
+
+    def submit(self, fileArgs=(), verbose=True, onDone=None, plan=None):
+        key = tuple(fileArgs)
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        self.jobs.put((key, verbose, onDone, plan))
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='P4UCB sync', daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self):
+        self.jobs.put(None)
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+    def sync(self, connection, fileArgs, progress, plan=None, notes=None):
+        """Plan, then sync on one connection, in parallel when configured and worth it.
+
+        Parallel transfer is used when the plan is at least sync_parallel_bytes. It
+        prefers the server's own `sync --parallel`; if the server refuses it the
+        files are synced through the client-side SyncPool instead. A server that
+        syncs serially with a warning is not asked again.
+        """
+        if plan is None:
+            plan = planSync(connection, fileArgs)
+            plan.applyConfig()
+        if notes is not None:
+            notes.extend(plan.summary()[1:])
+        if not plan.files:
+            return []
+
+        settings = parallelSyncSettings()
+        if settings['threads'] <= 1 or plan.totalBytes < config.getint('sync_parallel_bytes', fallback=0):
+            return syncRevisions(connection, plan.files)
+
+        if self.serverParallel is not False:
+            options = 'threads={threads},batch={batch}'.format(**settings)
+            if settings['batchsize'] > 0:
+                options += ',batchsize={}'.format(settings['batchsize'])
+            revisions = ['{}#{}'.format(fileInfo['depotFile'], fileInfo['rev']) for fileInfo in plan.files]
+            try:
+                with connection.at_exception_level(P4.RAISE_ERROR): # keep the result of a serial sync
+                    result = connection.run_sync('--parallel=' + options, revisions)
+            except P4Exception as e:
+                if 'parallel' not in str(e).lower():
+                    raise
+                if notes is not None:
+                    notes.append("Server does not support parallel sync, using {} connections".format(settings['threads']))
+                self.serverParallel = False
+            else:
+                # a warning about parallel means the server synced the files serially,
+                # they are already here; later syncs go through the SyncPool
+                self.serverParallel = not any('parallel' in str(warning).lower() for warning in connection.warnings)
+                if not self.serverParallel and notes is not None:
+                    notes.append("Server synced serially, next time using {} connections".format(settings['threads']))
+                return result
+
+        if len(plan.files) <= settings['batch']:
+            return syncRevisions(connection, plan.files)
+        progress.init(Progress.TYPE_RECEIVEFILE)
+        progress.setTotal(len(plan.files))
+        try:
+            return self.pool.sync(plan.files, settings, progress)
+        finally:
+            progress.done(False)
+
+    def connect(self):
+        if self.connection is None or not self.connection.connected():
+            self.connection = newP4Connection()
+        return self.connection
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            fileArgs, verbose, onDone, plan = job
+            result = None
+            warnings = []
+            notes = []
+            error = None
+            try:
+                connection = self.connect()
+                progress = MayaProgress('Syncing from Perforce...')
+                connection.progress = progress
+                try:
+                    # warnings such as "up-to-date" or "no such file" must not discard the result
+                    with connection.at_exception_level(P4.RAISE_ERROR):
+                        result = self.sync(connection, list(fileArgs), progress, plan, notes)
+                    warnings = list(connection.warnings) + notes
+                finally:
+                    connection.progress = None
+            except Exception as e:
+                error = e
+            with self.lock:
+                self.pending.discard(fileArgs)
+            maya.utils.executeDeferred(syncFinished, result, warnings, error, verbose, onDone)
+
+        if self.connection is not None and self.connection.connected():
+            self.connection.disconnect()
+        self.pool.close()
+
+syncWorker = SyncWorker()
+
+
+def syncFinished(changedFiles, warnings, error, verbose, onDone=None):
+    """Runs on the main thread once a background sync has completed."""
+    haveSnapshot.invalidate()
+    workspaceWatcher.ignoreResults(changedFiles)
+    for warning in warnings:
+        print("Warning: " + str(warning).strip())
+
+    if error is not None:
+        cmds.confirmDialog(title='Error Syncing', icon='critical',
+                           message=str(error), button=["ok"])
+    elif not changedFiles:
+        if verbose:
+            cmds.confirmDialog(title='Succcessfully synced',
+                               message='Files are already up to date', button=["ok"])
+    else:
+        print("Synced {} files".format(len(changedFiles)))
+        """filepath = getRelativeFilePath()
+        for fileInfo in changedFiles:
             if (fileInfo['depotFile'] == filepath):
                 reloadResponse = cmds.confirmDialog(title='Reload?', message='The current file was just updated with the last sync, would you like to re-open it?', button=["Yes", "No"])
                 if reloadResponse == "Yes":
                     mel.eval("fopen " + cmds.file(q=True, sn=True))
                 return"""
-    except Exception as e:
-        if 'up-to-date' in str(e):
-            if verbose:
-                cmds.confirmDialog(title='Succcessfully synced',
-                                   message='Files are already up to date', button=["ok"])
+    if onDone:
+        onDone(changedFiles, error)
+
+
+def p4GetLatest(*args, verbose=True):
+    """Sync the workspace on the background worker.
+
+    The worker previews the sync first and leaves out directories over the skip
+    thresholds (config.txt); what was skipped is reported by syncFinished.
+    """
+    print("p4GetLatest")
+    connectToP4()
+    if not syncWorker.submit(verbose=verbose):
+        print("Sync already in progress")
+
+def p4SyncScene(*args, verbose=True, fullSyncAfter=False):
+    """Sync only the open scene's dependency closure in one batched sync.
+
+    With fullSyncAfter the rest of the workspace is synced lazily once that is done.
+    """
+    print("p4SyncScene")
+    depotPaths = sorted(set(filter(None, map(localToDepotPath, getSceneDependencies()))))
+    if (not depotPaths):
+        print("Warning: No scene dependencies found inside the workspace")
+        return
+    connectToP4()
+
+    def syncRest(changedFiles, error):
+        syncWorker.submit(verbose=False)
+
+    syncWorker.submit(depotPaths, verbose=verbose, onDone=syncRest if fullSyncAfter else None)
+
+def p4CheckoutFiles(depotFiles):
+    """Check out and lock depot files (wildcards allowed) with one opened -a, one edit and one lock.
+
+    Files locked by someone else are left alone and reported in a single dialog.
+    Returns the depot files that were opened.
+    """
+    if (not depotFiles):
+        return []
+    connectToP4()
+
+    with p4.at_exception_level(P4.RAISE_ERROR):
+        openedResult = p4.run("opened", "-a", depotFiles)
+    lockedBy = {}
+    for fileInfo in openedResult:
+        if 'ourLock' in fileInfo.keys():
+            lockedBy[fileInfo['depotFile']] = fileInfo['user']
+
+    if lockedBy:
+        if len(lockedBy) == 1 and len(depotFiles) == 1:
+            message = 'This file is currently checked out and locked by: {}'.format(list(lockedBy.values())[0])
         else:
-            cmds.confirmDialog(title='Error Syncing', icon='critical',
-                               message=str(e), button=["ok"])
+            lines = ['{} ({})'.format(depotFile, user) for depotFile, user in sorted(lockedBy.items())]
+            if len(lines) > 20:
+                lines = lines[:20] + ['... and {} more'.format(len(lines) - 20)]
+            message = 'These files are checked out and locked by someone else and were skipped:\n' + '\n'.join(lines)
+        cmds.confirmDialog(title='File Locked', icon='critical', message=message, button=["ok"])
+
+    myFiles = [depotFile for depotFile in depotFiles if depotFile not in lockedBy]
+    if (not myFiles):
+        return []
+    with p4.at_exception_level(P4.RAISE_ERROR):
+        editResult = p4.run( "edit", myFiles)
+        openedIndex.markOpened(editResult)
+        editedFiles = [fileInfo['depotFile'] for fileInfo in editResult if isinstance(fileInfo, dict)]
+        fileStates.invalidate(editedFiles)
+        lockedEdits = [depotFile for depotFile in editedFiles if depotFile in lockedBy]
+        if lockedEdits: # a wildcard matched files locked by someone else, give them back
+            revertResult = p4.run( "revert", lockedEdits)
+            workspaceWatcher.ignoreResults(revertResult)
+            openedIndex.markClosed(lockedEdits)
+            editedFiles = [depotFile for depotFile in editedFiles if depotFile not in lockedBy]
+        if editedFiles:
+            p4.run( "lock", editedFiles )
+    for warning in p4.warnings:
+        print("Warning: " + str(warning).strip())
+    if editedFiles:
+        startDigestCheck()
+    return editedFiles
+
+def p4AddFiles(depotFiles):
+    """Open files for add with a single command. Returns the depot files that were opened."""
+    if (not depotFiles):
+        return []
+    connectToP4()
+    with p4.at_exception_level(P4.RAISE_ERROR):
+        addResult = p4.run( "add", depotFiles)
+    openedIndex.markOpened(addResult)
+    addedFiles = [fileInfo['depotFile'] for fileInfo in addResult if isinstance(fileInfo, dict)]
+    fileStates.invalidate(addedFiles)
+    return addedFiles
+
+def p4RevertFiles(depotFiles):
+    """Revert depot files (wildcards allowed) with a single command. Returns the reverted depot files."""
+    if (not depotFiles):
+        return []
+    connectToP4()
+    autosave.release(depotFiles, reopen=False)
+    with p4.at_exception_level(P4.RAISE_ERROR):
+        revertResult = p4.run("revert", depotFiles)
+    workspaceWatcher.ignoreResults(revertResult)
+    revertedFiles = [fileInfo['depotFile'] for fileInfo in revertResult if isinstance(fileInfo, dict)]
+    openedIndex.markClosed(revertedFiles)
+    fileStates.invalidate(revertedFiles)
+    return revertedFiles
 
 def p4Checkout(*args):
     print("p4Checkout")
@@ -124,16 +1011,7 @@ def p4Checkout(*args):
     if (not relativeFilePath): #invalid file, skip
         return
 
-    openedResult = p4.run("opened","-a", relativeFilePath)
-    for fileInfo in openedResult:
-        if 'ourLock' in fileInfo.keys():
-            cmds.confirmDialog(title='File Locked', icon='critical',
-                                   message='This file is currently checked out and locked by: {}'.format(fileInfo['user']), button=["ok"])
-            return
-
-    myFiles = [relativeFilePath]
-    p4.run( "edit", myFiles)
-    p4.run( "lock", myFiles )
+    p4CheckoutFiles([relativeFilePath])
 
 def p4Add(*args):
     print("p4Add")
@@ -143,109 +1021,836 @@ def p4Add(*args):
     if (not relativeFilePath): #invalid file, skip
         return
 
-    myFiles = [relativeFilePath]
-    p4.run( "add", myFiles)
-
-def p4Submit(*args):
-    print("p4Submit")
-    connectToP4()
-
-    openedFiles = getOpenedList()
+    p4AddFiles([relativeFilePath])
 
-    def submitFiles(*args):
-        selectedFiles = []
-        for i in range(len(openedFiles)):
-            if (cmds.checkBox("cb" + str(i), query=True, value=True)):
-                selectedFiles.append(openedFiles[i])
-        cmds.layoutDialog( dismiss="Continue")
+def p4CheckoutSelection(*args):
+    print("p4CheckoutSelection")
+    p4CheckoutFiles(getSelectedDepotFiles())
 
-        if (len(selectedFiles) <= 0):
-            return # no files selected, nothing to submit
+def p4CheckoutDirectory(*args):
+    print("p4CheckoutDirectory")
+    directory = chooseDirectory()
+    if directory:
+        p4CheckoutFiles([localToDepotPath(directory + '/') + '...'])
 
-        result = cmds.promptDialog(title='Submit Changes', message="Enter a change description",
-                                  button=['Cancel', 'Submit'])
-        if result == 'Submit':
-            inputDescription = cmds.promptDialog(query=True, text=True) or "Blank Description"
-            change = p4.fetch_change()
+def p4AddSelection(*args):
+    print("p4AddSelection")
+    p4AddFiles(getSelectedDepotFiles())
 
-            myFiles = selectedFiles
-            change._description = inputDescription
-            change._files = myFiles
-            p4.run_submit( change )
+def p4AddDirectory(*args):
+    """Add every file under a directory; files already in the depot are skipped by the server."""
+    print("p4AddDirectory")
+    directory = chooseDirectory()
+    if (not directory):
+        return
+    localFiles = []
+    for root, dirs, files in os.walk(directory):
+        localFiles.extend(os.path.join(root, name) for name in files)
+    p4AddFiles(sorted(set(filter(None, map(localToDepotPath, localFiles)))))
 
-    def checkboxPrompt():
-        # Get the dialog's formLayout.
-        #
-        form = cmds.setParent(q=True)
+class PendingSubmits:
+    """Numbered changes whose submit was started from this machine and has not finished.
 
-        # layoutDialog's are not resizable, so hard code a size here,
-        # to make sure all UI elements are visible.
-        #
-        cmds.formLayout(form, e=True, width=300)
+    The record is kept in pending_submits.json next to the plug-in, so a change left
+    pending by a failed upload or by closing Maya can be resumed later.
+    """
 
-        t = cmds.text(l='Files To Submit')
+    def __init__(self):
+        self.path = os.path.join(pluginDir, 'pending_submits.json')
+        self.lock = threading.Lock()
 
-        spacer = 5
-        top = 5
-        edge = 5
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, changes):
+        with open(self.path, 'w') as f:
+            json.dump(changes, f, indent=1)
+
+    def add(self, change, description, files):
+        with self.lock:
+            changes = self.load()
+            changes[str(change)] = {'description': description, 'files': list(files), 'started': time.time()}
+            self.save(changes)
+
+    def remove(self, change):
+        with self.lock:
+            changes = self.load()
+            if changes.pop(str(change), None) is not None:
+                self.save(changes)
+
+    def files(self):
+        return set(f for record in self.load().values() for f in record['files'])
+
+pendingSubmits = PendingSubmits()
+
+
+class SubmitWorker:
+    """Submits numbered changes on a dedicated thread with its own P4 connection.
+
+    Upload progress goes to Maya's progress bar and completion is posted back to
+    the main thread with executeDeferred. With submit_parallel_threads > 1
+    (config.txt) `submit --parallel` is tried first.
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.connection = None
+        self.serverParallel = None # unknown until the first parallel submit
+
+    def isBusy(self):
+        with self.lock:
+            return len(self.pending) > 0
+
+    def submit(self, change, files):
+        with self.lock:
+            if change in self.pending:
+                return False
+            self.pending.add(change)
+        self.jobs.put((change, files))
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, name='P4UCB submit', daemon=True)
+            self.thread.start()
+        return True
+
+    def stop(self):
+        self.jobs.put(None)
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+    def connect(self):
+        if self.connection is None or not self.connection.connected():
+            self.connection = newP4Connection()
+        return self.connection
+
+    def submitChange(self, connection, change):
+        threads = config.getint('submit_parallel_threads', fallback=0)
+        if threads > 1 and self.serverParallel is not False:
+            options = 'threads={},batch={}'.format(threads, config.getint('submit_parallel_batch', fallback=8))
+            try:
+                result = connection.run_submit('--parallel=' + options, '-c', change)
+                self.serverParallel = True
+                return result
+            except P4Exception as e:
+                if 'parallel' not in str(e).lower():
+                    raise
+            self.serverParallel = False
+        return connection.run_submit('-c', change)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            change, files = job
+            result = None
+            error = None
+            try:
+                connection = self.connect()
+                connection.progress = MayaProgress('Submitting change {} to Perforce...'.format(change))
+                try:
+                    result = self.submitChange(connection, change)
+                finally:
+                    connection.progress = None
+                pendingSubmits.remove(change)
+            except Exception as e:
+                error = e
+            with self.lock:
+                self.pending.discard(change)
+            maya.utils.executeDeferred(submitFinished, change, files, result, error)
+
+        if self.connection is not None and self.connection.connected():
+            self.connection.disconnect()
+
+submitWorker = SubmitWorker()
+
+
+def submitFinished(change, files, result, error):
+    """Runs on the main thread once a background submit has completed."""
+    openedIndex.invalidate()
+    haveSnapshot.invalidate()
+    fileStates.invalidate(files)
+    if error is not None:
+        cmds.confirmDialog(title='Error Submitting', icon='critical',
+                           message="Change {} was left pending, use Resume Pending Submits to retry it.\n\n{}".format(change, error),
+                           button=["ok"])
+        return
+    workspaceWatcher.ignoreDepotFiles(files) # submit makes them read-only
+    submitted = [r['submittedChange'] for r in result if isinstance(r, dict) and 'submittedChange' in r]
+    print("Submitted change {}".format(submitted[-1] if submitted else change))
+
+
+def fileDigest(path, chunkSize=8 * 1024 * 1024):
+    """MD5 of a local file as Perforce reports it (upper case hex).
+
+    The file is memory-mapped and hashed in chunks without copying it through
+    Python objects; hashlib releases the GIL for each chunk, so several files can
+    be hashed in parallel on the digest threads.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return md5.hexdigest().upper()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as view:
+                for offset in range(0, size, chunkSize):
+                    md5.update(view[offset:offset + chunkSize])
+    return md5.hexdigest().upper()
+
+digestExecutor = None
+
+def digestPool():
+    """Threads for hashing local files off the main thread (digest_threads in config.txt)."""
+    global digestExecutor
+    if digestExecutor is None:
+        digestExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=config.getint('digest_threads', fallback=4),
+                                                               thread_name_prefix='P4UCB digest')
+    return digestExecutor
+
+
+class DigestCache:
+    """Persistent MD5s of local files, keyed by path, size, mtime and inode.
+
+    Kept in digest_cache.db next to the plug-in for the workspace in config.txt.
+    A file is hashed again only once its size, mtime or inode changes, so checks
+    over the whole workspace cost one stat per file plus hashing what changed.
+    Misses are hashed in parallel on the digest threads.
+    """
+
+    QUERY_CHUNK = 500 # paths per SELECT, below SQLite's parameter limit
+
+    def __init__(self):
+        self.path = os.path.join(pluginDir, 'digest_cache.db')
+        self.db = None
+        self.lock = threading.Lock() # the connection is shared by the main and worker threads
+
+    def openStore(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, '
+                            'size INTEGER, mtime INTEGER, inode INTEGER, digest TEXT)')
+            meta = dict(self.db.execute('SELECT key, value FROM meta'))
+            if meta.get('client') != config['client']:
+                self.db.execute('DELETE FROM digests') # hashed for another workspace
+                self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('client', config['client']))
+            self.db.commit()
+        return self.db
+
+    @staticmethod
+    def key(stat):
+        return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    def lookup(self, paths):
+        """Cached digests of paths that have not changed since they were hashed.
+
+        Returns (digests, misses) where misses maps each other readable path to its os.stat().
+        """
+        stats = {}
+        for path in paths:
+            try:
+                stats[path] = os.stat(path)
+            except OSError:
+                pass
+        rows = {}
+        statted = list(stats)
+        if not statted:
+            return {}, {}
+        with self.lock:
+            db = self.openStore()
+            for start in range(0, len(statted), self.QUERY_CHUNK):
+                chunk = statted[start:start + self.QUERY_CHUNK]
+                rows.update((row[0], row[1:]) for row in db.execute(
+                    'SELECT path, size, mtime, inode, digest FROM digests WHERE path IN ({})'.format(
+                        ','.join('?' * len(chunk))), chunk))
+        digests = {}
+        misses = {}
+        for path, stat in stats.items():
+            row = rows.get(path)
+            if row is not None and tuple(row[:3]) == self.key(stat):
+                digests[path] = row[3]
+            else:
+                misses[path] = stat
+        return digests, misses
+
+    def store(self, entries):
+        """Record (path, stat, digest) entries."""
+        rows = [(path,) + self.key(stat) + (digest,) for path, stat, digest in entries]
+        if rows:
+            with self.lock:
+                self.openStore().executemany('INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)', rows)
+                self.db.commit()
+
+    def digests(self, paths):
+        """MD5 of each readable path, hashing only new or modified files."""
+        digests, misses = self.lookup(paths)
+        futures = [(path, stat, digestPool().submit(fileDigest, path)) for path, stat in misses.items()]
+        entries = []
+        for path, stat, future in futures:
+            try:
+                digests[path] = future.result()
+            except OSError:
+                continue
+            entries.append((path, stat, digests[path]))
+        self.store(entries)
+        return digests
+
+    def digest(self, path):
+        return self.digests([path]).get(path)
+
+    def forget(self, paths):
+        with self.lock:
+            self.openStore().executemany('DELETE FROM digests WHERE path = ?', [(path,) for path in paths])
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+digestCache = DigestCache()
+
+
+class DigestCheck:
+    """Finds opened files whose local content is identical to the revision they were opened at.
+
+    One `fstat -Ol` asks the server for the have revisions' digests; the local
+    files are hashed on the digest threads while the caller carries on, e.g. while
+    the submit dialog is open. Only edits are candidates, and files whose size
+    differs are known to be changed without hashing them.
+    """
+
+    def __init__(self, depotFiles, connection=None):
+        self.futures = {}
+        self.cached = {}
+        self.depotFiles = set(depotFiles or ())
+        if not depotFiles or not config.getboolean('skip_unchanged', fallback=True):
+            return
+        connection = connection or p4
+        with connection.at_exception_level(P4.RAISE_ERROR):
+            stats = connection.run_fstat('-Ol', '-T', 'depotFile,clientFile,action,fileSize,digest',
+                                 ['{}#have'.format(depotFile) for depotFile in depotFiles])
+        candidates = {}
+        for fileInfo in stats:
+            if not isinstance(fileInfo, dict) or fileInfo.get('action') != 'edit' or not fileInfo.get('digest'):
+                continue
+            candidates[fileInfo.get('clientFile')] = fileInfo
+        digests, misses = digestCache.lookup(candidates)
+        for path, digest in digests.items():
+            fileInfo = candidates[path]
+            self.cached[fileInfo['depotFile']] = (fileInfo['digest'].upper(), path, None, digest)
+        for path, stat in misses.items():
+            fileInfo = candidates[path]
+            try:
+                if stat.st_size != int(fileInfo.get('fileSize', -1)):
+                    continue
+            except (TypeError, ValueError):
+                continue
+            self.futures[fileInfo['depotFile']] = (fileInfo['digest'].upper(), path, stat,
+                                                   digestPool().submit(fileDigest, path))
+
+    def covers(self, depotFiles):
+        """Whether every one of depotFiles was opened when the check started."""
+        return set(depotFiles) <= self.depotFiles
+
+    def unchanged(self, depotFiles=None, wait=True):
+        """The files (of depotFiles, default all checked) that are unchanged, waiting for their digests.
+
+        With wait=False nothing blocks: files still being hashed count as changed.
+        """
+        result = [depotFile for depotFile, (serverDigest, path, stat, digest) in self.cached.items()
+                  if (depotFiles is None or depotFile in depotFiles) and digest == serverDigest]
+        hashed = []
+        for depotFile, (serverDigest, path, stat, future) in self.futures.items():
+            if depotFiles is not None and depotFile not in depotFiles:
+                continue
+            if not wait and not future.done():
+                continue
+            try:
+                digest = future.result()
+            except OSError:
+                continue # unreadable, let the submit deal with it
+            hashed.append((path, stat, digest))
+            if digest == serverDigest:
+                result.append(depotFile)
+        digestCache.store(hashed)
+        return result
+
+
+class DigestChecker:
+    """Keeps a DigestCheck of every opened file, for close_callback to read without waiting.
+
+    start() only wakes a thread with its own P4 connection, which runs the
+    `p4 opened` and the check's `fstat -Ol`; requests made while a check is being
+    set up collapse into one. latest is the most recent check, or None.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.connection = None
+        self.latest = None
+
+    def start(self):
+        if not config.getboolean('skip_unchanged', fallback=True):
+            return
+        self.wakeup.set()
+        if self.thread is None or not self.thread.is_alive():
+            self.stopping = threading.Event()
+            self.thread = threading.Thread(target=self.run, args=(self.stopping,), name='P4UCB digest check', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def check(self):
+        if self.connection is None or not self.connection.connected():
+            self.connection = newP4Connection()
+        with self.connection.at_exception_level(P4.RAISE_ERROR): # "file(s) not opened"
+            opened = self.connection.run_opened()
+        return DigestCheck([fileInfo['depotFile'] for fileInfo in opened if isinstance(fileInfo, dict)], self.connection)
+
+    def run(self, stopping):
+        while True:
+            self.wakeup.wait()
+            if stopping.is_set():
+                break
+            self.wakeup.clear()
+            try:
+                self.latest = self.check()
+            except Exception as e:
+                self.latest = None
+                print("Could not check opened files for changes: " + str(e).strip())
+        if self.connection is not None and self.connection.connected():
+            self.connection.disconnect()
+
+digestChecker = DigestChecker()
+
+def startDigestCheck():
+    """Start checking the opened files in the background, after a save or checkout."""
+    digestChecker.start()
+
+
+def revertUnchanged(depotFiles):
+    """Revert (revert -a) the files that have not changed. Returns the reverted depot files."""
+    autosave.release(depotFiles, reopen=False)
+    with p4.at_exception_level(P4.RAISE_ERROR):
+        revertResult = p4.run_revert('-a', depotFiles)
+    workspaceWatcher.ignoreResults(revertResult)
+    revertedFiles = [fileInfo['depotFile'] for fileInfo in revertResult if isinstance(fileInfo, dict)]
+    openedIndex.markClosed(revertedFiles)
+    fileStates.invalidate(revertedFiles)
+    return revertedFiles
+
+
+class ShelveAutosave:
+    """Periodically shelves opened files whose content changed into one pending change.
+
+    Enabled with autosave_shelve (config.txt). Every autosave_interval seconds the
+    thread digests the files opened in the default or autosave change, moves the
+    changed ones into the autosave change and shelves just those. At most
+    autosave_max_bytes are shelved per round, the rest wait for the next one.
+    Submit and revert take their files back out with release().
+    """
+
+    DESCRIPTION = 'P4UCB autosave'
+
+    def __init__(self):
+        self.thread = None
+        self.stopping = threading.Event()
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock() # held while files move in or out of the autosave change
+        self.releases = 0 # counts release() calls, so a round can tell it raced with one
+        self.connection = None
+        self.change = None
+        self.digests = {} # depotFile -> digest at the last shelve
+
+    def enabled(self):
+        return config.getboolean('autosave_shelve', fallback=False)
+
+    def start(self):
+        if not self.enabled() or (self.thread and self.thread.is_alive()):
+            return
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='P4UCB autosave', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+
+    def trigger(self, *args):
+        """Shelve now instead of waiting for the interval."""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = None
+            if not self.enabled():
+                cmds.confirmDialog(title='Autosave', message='Set autosave_shelve to true in P4 -> Setup Plugin first',
+                                   button=["ok"])
+                return
+            self.start()
+        self.wakeup.set()
+
+    def findChange(self, connection, create=True):
+        """The autosave change of this workspace, created on first use when create is set."""
+        if self.change is None:
+            pending = connection.run_changes('-s', 'pending', '-l', '-c', connection.client)
+            for change in pending:
+                if change.get('desc', '').strip() == self.DESCRIPTION:
+                    self.change = change['change']
+                    break
+            else:
+                if not create:
+                    return None
+                spec = connection.fetch_change()
+                spec._description = self.DESCRIPTION
+                spec._files = []
+                self.change = connection.save_change(spec)[0].split()[1]
+        return self.change
+
+    def changedFiles(self, connection, change):
+        """Opened files in the default or autosave change whose digest changed, within the size budget."""
+        with connection.at_exception_level(P4.RAISE_ERROR):
+            opened = connection.run_fstat('-Ro', '-T', 'depotFile,clientFile,change', '//{}/...'.format(connection.client))
+        budget = config.getint('autosave_max_bytes', fallback=2 * 1024 * 1024 * 1024)
+        changed = []
+        for fileInfo in opened:
+            if not isinstance(fileInfo, dict) or fileInfo.get('change') not in ('default', change):
+                continue
+            path = fileInfo.get('clientFile')
+            if not path or not os.path.isfile(path):
+                continue
+            size = os.path.getsize(path)
+            if changed and size > budget:
+                continue
+            digest = digestCache.digest(path)
+            if digest is None or self.digests.get(fileInfo['depotFile']) == digest:
+                continue
+            changed.append((fileInfo, digest))
+            budget -= size
+        return changed
+
+    def shelve(self):
+        if self.connection is None or not self.connection.connected():
+            self.connection = newP4Connection()
+        connection = self.connection
+        releases = self.releases
+        change = self.findChange(connection)
+        changed = self.changedFiles(connection, change)
+        if not changed:
+            return 0
+        with self.lock:
+            if releases != self.releases:
+                return 0 # files were released while hashing, they are picked up next round
+            moving = [fileInfo['depotFile'] for fileInfo, digest in changed if fileInfo['change'] == 'default']
+            if moving:
+                connection.run_reopen('-c', change, moving)
+        try:
+            connection.run_shelve('-f', '-c', change, [fileInfo['depotFile'] for fileInfo, digest in changed])
+            for fileInfo, digest in changed:
+                self.digests[fileInfo['depotFile']] = digest
+        finally:
+            if releases != self.releases:
+                self.pruneShelf(connection, change)
+        maya.utils.executeDeferred(openedIndex.invalidate)
+        return len(changed)
+
+    def pruneShelf(self, connection, change):
+        """Delete shelved files that are no longer opened in the autosave change.
+
+        A release() that ran during the upload can leave a copy behind.
+        """
+        with self.lock, connection.at_exception_level(P4.RAISE_ERROR):
+            described = connection.run_describe('-S', '-s', change)
+            shelved = set(described[0].get('depotFile', [])) if described else set()
+            opened = set(fileInfo['depotFile'] for fileInfo in connection.run_opened('-c', change)
+                         if isinstance(fileInfo, dict))
+            stale = sorted(shelved - opened)
+            if stale:
+                connection.delete_shelve('-c', change, stale)
+
+    def release(self, depotFiles, reopen=True):
+        """Delete the shelved copies of depotFiles (wildcards allowed) and move them back to the default change.
+
+        The lock is only held while the files move, never during an autosave's hashing or upload.
+        """
+        if not self.enabled() and self.change is None:
+            return
+        change = self.findChange(p4, create=False)
+        if change is None:
+            return
+        with self.lock:
+            self.releases += 1
+            with p4.at_exception_level(P4.RAISE_ERROR): # "file(s) not opened on this client"
+                inChange = sorted(fileInfo['depotFile'] for fileInfo in p4.run_opened('-c', change, depotFiles)
+                                  if isinstance(fileInfo, dict))
+            if not inChange:
+                return
+            with p4.at_exception_level(P4.RAISE_NONE): # files that were never shelved
+                p4.delete_shelve('-c', change, inChange)
+            if reopen:
+                with p4.at_exception_level(P4.RAISE_ERROR):
+                    p4.run_reopen('-c', 'default', inChange)
+            for depotFile in inChange:
+                self.digests.pop(depotFile, None)
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.wakeup.wait(config.getfloat('autosave_interval', fallback=600))
+            self.wakeup.clear()
+            if self.stopping.is_set() or not self.enabled():
+                break
+            try:
+                count = self.shelve()
+                if count:
+                    print("Autosave shelved {} files in change {}".format(count, self.change))
+            except P4Exception as e:
+                print("Warning: Autosave failed: " + str(e).strip())
+                if isConnectionError(e) and self.connection is not None:
+                    self.connection.disconnect()
+
+        if self.connection is not None and self.connection.connected():
+            self.connection.disconnect()
+
+autosave = ShelveAutosave()
+
+
+def startSubmit(files, description):
+    """Move the files into a new numbered change and submit it in the background.
+
+    The change is recorded in pendingSubmits before the upload starts and removed
+    once it is submitted.
+    """
+    autosave.release(files)
+    change = p4.fetch_change()
+    change._description = description
+    change._files = files
+    result = p4.save_change(change)
+    changeNumber = result[0].split()[1]
+    pendingSubmits.add(changeNumber, description, files)
+    openedIndex.markClosed(files)
+    submitWorker.submit(changeNumber, files)
+    print("Submitting change {} ({} files)".format(changeNumber, len(files)))
+    return changeNumber
+
+def p4ResumeSubmits(*args, ask=False):
+    """Resubmit the changes left pending by an interrupted submit.
+
+    Changes that have since been submitted or deleted are dropped from the record.
+    With ask=True (plug-in load) the user is asked first.
+    """
+    changes = pendingSubmits.load()
+    if not changes:
+        if not ask:
+            cmds.confirmDialog(title='Resume Pending Submits', message='There are no pending submits', button=["ok"])
+        return
+    connectToP4()
 
-        # What the actual fuck is this UI system...
-        attachForm = [(t, 'top', top), (t, 'left', edge), (t, 'right', edge)]
-        attachNone = [(t, 'bottom')]
-        attachControl = []
-        attachPosition = []
+    resumable = []
+    for change, record in sorted(changes.items()):
+        if submitWorker.isBusy() and change in submitWorker.pending:
+            continue
+        try:
+            status = p4.fetch_change(change)._status
+        except P4Exception:
+            status = None
+        if status == 'pending':
+            resumable.append((change, record))
+        else:
+            pendingSubmits.remove(change)
+    if not resumable:
+        return
 
-        above = t
+    if ask:
+        message = "{} change(s) were not fully submitted:\n\n{}\n\nSubmit them now?".format(
+            len(resumable), "\n".join("{}: {}".format(change, record['description']) for change, record in resumable))
+        if cmds.confirmDialog(title='Resume Pending Submits', message=message, button=['Submit', 'Later']) != 'Submit':
+            return
+    for change, record in resumable:
+        submitWorker.submit(change, record['files'])
+
+class SubmitList:
+    """The submit dialog's file list, kept as data rather than one widget per file.
+
+    Rows are shown in a single textScrollList, whose selection is the set of files
+    to submit. Filters only change which rows are listed; the selection of hidden
+    rows is kept, and All/None apply to the listed rows.
+    """
+
+    ALL = '(all)'
+
+    def __init__(self, fileInfos):
+        self.rows = sorted(fileInfos, key=lambda fileInfo: fileInfo['depotFile'])
+        self.selected = set(fileInfo['depotFile'] for fileInfo in self.rows)
+        self.directory = ''
+        self.action = self.ALL
+        self.fileType = self.ALL
+        self.visible = self.rows
+        self.list = None
+        self.status = None
+
+    @staticmethod
+    def baseType(fileInfo):
+        return fileInfo.get('type', '').split('+')[0]
+
+    def actions(self):
+        return sorted(set(fileInfo.get('action', '') for fileInfo in self.rows))
+
+    def fileTypes(self):
+        return sorted(set(self.baseType(fileInfo) for fileInfo in self.rows))
+
+    def applyFilters(self):
+        directory = self.directory.strip().lower()
+        self.visible = [fileInfo for fileInfo in self.rows
+                        if directory in fileInfo['depotFile'].lower()
+                        and self.action in (self.ALL, fileInfo.get('action'))
+                        and self.fileType in (self.ALL, self.baseType(fileInfo))]
+
+    def selectVisible(self, value):
+        visibleFiles = set(fileInfo['depotFile'] for fileInfo in self.visible)
+        if value:
+            self.selected |= visibleFiles
+        else:
+            self.selected -= visibleFiles
+        self.redraw()
 
-        checkBoxes = []
-        count = 0
-        for file in openedFiles:
-            cb = cmds.checkBox("cb" + str(count), label = file, value = True)
-            checkBoxes.append(cb)
+    def selectedFiles(self):
+        return [fileInfo['depotFile'] for fileInfo in self.rows if fileInfo['depotFile'] in self.selected]
 
-            attachControl.append((cb, 'top', spacer, above))
-            attachForm.append((cb, 'left', edge))
-            attachForm.append((cb, 'right', edge))
-            attachNone.append((cb, 'bottom'))
+    @staticmethod
+    def label(fileInfo):
+        return "{}    [{}, {}]".format(fileInfo['depotFile'], fileInfo.get('action', ''), fileInfo.get('type', ''))
 
-            above = cb
-            count += 1
-        
+    def redraw(self):
+        if self.list is None:
+            return
+        cmds.textScrollList(self.list, edit=True, removeAll=True)
+        if self.visible:
+            cmds.textScrollList(self.list, edit=True, append=[self.label(fileInfo) for fileInfo in self.visible])
+            indices = [n + 1 for n, fileInfo in enumerate(self.visible) if fileInfo['depotFile'] in self.selected]
+            if indices:
+                cmds.textScrollList(self.list, edit=True, selectIndexedItem=indices)
+        self.updateStatus()
+
+    def updateStatus(self):
+        if self.status is not None:
+            cmds.text(self.status, edit=True, label="{} of {} files selected ({} listed)".format(
+                len(self.selected), len(self.rows), len(self.visible)))
+
+    def selectionChanged(self, *args):
+        indices = set(cmds.textScrollList(self.list, query=True, selectIndexedItem=True) or [])
+        for n, fileInfo in enumerate(self.visible):
+            if n + 1 in indices:
+                self.selected.add(fileInfo['depotFile'])
+            else:
+                self.selected.discard(fileInfo['depotFile'])
+        self.updateStatus()
+
+    def filterChanged(self, directory=None, action=None, fileType=None):
+        if directory is not None:
+            self.directory = directory
+        if action is not None:
+            self.action = action
+        if fileType is not None:
+            self.fileType = fileType
+        self.applyFilters()
+        self.redraw()
+
+    def build(self, onContinue):
+        """Create the dialog's controls, to be called from a layoutDialog ui function."""
+        form = cmds.setParent(q=True)
+        cmds.formLayout(form, e=True, width=600)
+        column = cmds.columnLayout(adjustableColumn=True, rowSpacing=5)
+
+        cmds.text(label='Files To Submit', align='left')
+        cmds.rowLayout(numberOfColumns=6, adjustableColumn=2)
+        cmds.text(label='Path')
+        cmds.textField(text=self.directory, changeCommand=lambda text: self.filterChanged(directory=text))
+        cmds.optionMenu(label='Action', changeCommand=lambda value: self.filterChanged(action=value))
+        for value in [self.ALL] + self.actions():
+            cmds.menuItem(label=value)
+        cmds.optionMenu(label='Type', changeCommand=lambda value: self.filterChanged(fileType=value))
+        for value in [self.ALL] + self.fileTypes():
+            cmds.menuItem(label=value)
+        cmds.button(label='All', command=lambda *args: self.selectVisible(True))
+        cmds.button(label='None', command=lambda *args: self.selectVisible(False))
+        cmds.setParent(column)
+
+        self.list = cmds.textScrollList(allowMultiSelection=True, height=400,
+                                        selectCommand=self.selectionChanged)
+        self.status = cmds.text(label='', align='left')
+
+        cmds.rowLayout(numberOfColumns=2, adjustableColumn=1, columnAlign=(2, 'right'))
+        cmds.button(label='Cancel', command='cmds.layoutDialog( dismiss="Cancel")')
+        cmds.button(label='Continue', command=onContinue)
+        cmds.setParent(column)
+
+        cmds.formLayout(form, edit=True, attachForm=[(column, 'top', 5), (column, 'left', 5),
+                                                     (column, 'right', 5), (column, 'bottom', 5)])
+        self.redraw()
 
-        b1 = cmds.button(label='Cancel', c='cmds.layoutDialog( dismiss="Cancel")')
-        b2 = cmds.button(label='Continue', c=submitFiles)
 
-        attachForm.append((b1, 'left', edge))
-        attachForm.append((b2, 'right', edge))
-        attachForm.append((b1, 'bottom', edge))
-        attachForm.append((b2, 'bottom', edge))
+def p4Submit(*args):
+    print("p4Submit")
+    connectToP4()
 
-        attachControl.append((b1, 'top', spacer, above))
-        attachControl.append((b2, 'top', spacer, above))
+    inFlight = pendingSubmits.files()
+    openedFiles = openedIndex.refresh()
+    submitList = SubmitList([fileInfo for depotFile, fileInfo in openedFiles.items() if depotFile not in inFlight])
+    digestCheck = DigestCheck([fileInfo['depotFile'] for fileInfo in submitList.rows])
 
-        attachPosition.append((b1, 'right', spacer, 50))
-        attachPosition.append((b2, 'left', spacer, 50))
+    def submitFiles(*args):
+        selectedFiles = submitList.selectedFiles()
+        cmds.layoutDialog( dismiss="Continue")
 
+        unchanged = digestCheck.unchanged(set(selectedFiles))
+        if unchanged:
+            reverted = set(revertUnchanged(unchanged))
+            print("Reverted {} unchanged files".format(len(reverted)))
+            selectedFiles = [f for f in selectedFiles if f not in reverted]
+            if not selectedFiles:
+                cmds.confirmDialog(title='Submit Changes', button=["ok"],
+                                   message="None of the selected files were changed, they have been reverted")
+                return
 
-        cmds.formLayout(form, edit=True,
-                    attachForm = attachForm,
-                    attachNone = attachNone,
-                    attachControl = attachControl,
-                    attachPosition = attachPosition)
+        if (len(selectedFiles) <= 0):
+            return # no files selected, nothing to submit
 
+        result = cmds.promptDialog(title='Submit Changes', message="Enter a change description",
+                                  button=['Cancel', 'Submit'])
+        if result == 'Submit':
+            inputDescription = cmds.promptDialog(query=True, text=True) or "Blank Description"
+            startSubmit(selectedFiles, inputDescription)
 
-    if (len(openedFiles) > 0):
-        cmds.layoutDialog(ui=checkboxPrompt)
+    if (len(submitList.rows) > 0):
+        cmds.layoutDialog(ui=lambda: submitList.build(submitFiles))
     else:
         cmds.confirmDialog(title='Submit Changes', message="Nothing to submit", button=["ok"])
 
 
+def confirmRevert(description):
+    confirmResponse = cmds.confirmDialog(title='Are you sure?', message="Are you sure you want to revert all local changes made to {}?".format(description), button=["Revert","No"])
+    return confirmResponse == "Revert"
+
 def p4Revert(*args, filepathOverride = None):
     print("p4Revert")
 
     filename = cmds.file(q=True, sceneName=True)
-    confirmResponse = cmds.confirmDialog(title='Are you sure?', message="Are you sure you want to revert all local changes made to {}?".format(filename), button=["Revert","No"])
-    if (confirmResponse != "Revert"):
+    if (not confirmRevert(filename)):
         return
 
     connectToP4()
@@ -257,12 +1862,570 @@ def p4Revert(*args, filepathOverride = None):
     if (not relativeFilePath): #invalid file, skip
         return
 
-    myFiles = [relativeFilePath]
-    p4.run("revert", myFiles)
+    p4RevertFiles([relativeFilePath])
+
+def p4RevertSelection(*args):
+    print("p4RevertSelection")
+    depotFiles = getSelectedDepotFiles()
+    if depotFiles and confirmRevert("{} selected files".format(len(depotFiles))):
+        p4RevertFiles(depotFiles)
+
+def p4RevertDirectory(*args):
+    print("p4RevertDirectory")
+    directory = chooseDirectory()
+    if directory and confirmRevert(directory):
+        p4RevertFiles([localToDepotPath(directory + '/') + '...'])
+
+def clientRoot(connection):
+    """Local root directory of the connection's workspace."""
+    return connection.run_info()[0].get('clientRoot')
+
+def normalisePath(path):
+    return os.path.normcase(os.path.normpath(path))
+
+
+class HaveSnapshot:
+    """Compact local copy of `p4 have` for the workspace.
+
+    files maps each normalised local path to its depot path and revisions maps the
+    depot path to the have revision, with the depot paths interned so both share
+    them. Taken with one `p4 have` and reused for have_snapshot_ttl seconds
+    (config.txt); syncs and submits made by the plug-in invalidate it.
+    """
+
+    def __init__(self):
+        self.files = {}
+        self.revisions = {}
+        self.lastRefresh = None
+        self.refreshing = False
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        self.lastRefresh = None
+
+    def isStale(self):
+        return self.lastRefresh is None or \
+            time.time() - self.lastRefresh > config.getfloat('have_snapshot_ttl', fallback=300)
+
+    def refresh(self, connection, force=False):
+        """files and revisions of one snapshot, taken now if stale or with force."""
+        with self.lock:
+            if force or self.isStale():
+                with connection.at_exception_level(P4.RAISE_ERROR): # "file(s) not on client"
+                    have = connection.run_have()
+                files = {}
+                revisions = {}
+                for fileInfo in have:
+                    if isinstance(fileInfo, dict):
+                        depotFile = sys.intern(fileInfo['depotFile'])
+                        files[normalisePath(fileInfo.get('path') or fileInfo['clientFile'])] = depotFile
+                        revisions[depotFile] = int(fileInfo['haveRev'])
+                self.files, self.revisions = files, revisions
+                self.lastRefresh = time.time()
+            return self.files, self.revisions
+
+    def refreshInBackground(self):
+        """Take a fresh snapshot on a separate connection, if it is stale."""
+        if self.refreshing or not self.isStale():
+            return
+        self.refreshing = True
+
+        def refresh():
+            connection = None
+            try:
+                connection = newP4Connection()
+                self.refresh(connection)
+            except Exception as e:
+                print("Warning: Cannot read the have list: " + str(e).strip())
+            finally:
+                self.refreshing = False
+                if connection is not None and connection.connected():
+                    connection.disconnect()
+
+        threading.Thread(target=refresh, name='P4UCB have', daemon=True).start()
+
+    def haveRevision(self, depotFile):
+        """The synced revision of depotFile (0 if not synced), or None without a fresh snapshot."""
+        if self.isStale():
+            return None
+        return self.revisions.get(depotFile, 0)
+
+haveSnapshot = HaveSnapshot()
+
+
+def isIgnoredName(name, ignore):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in ignore)
+
+def isIgnoredPath(path, root, ignore):
+    """Whether a file under root, or any directory between it and root, matches an ignore pattern."""
+    relative = os.path.relpath(path, normalisePath(root))
+    return any(isIgnoredName(name, ignore) for name in relative.split(os.sep))
+
+def scanWorkspace(root, ignore=()):
+    """Every file under root as {normalised path: os.stat_result}.
+
+    Each top-level directory is walked with os.scandir on the digest threads.
+    Files and directories whose name matches an ignore pattern are skipped.
+    """
+    def ignored(name):
+        return isIgnoredName(name, ignore)
+
+    def walk(top):
+        found = {}
+        stack = [top]
+        while stack:
+            try:
+                entries = os.scandir(stack.pop())
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if ignored(entry.name):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        found[normalisePath(entry.path)] = entry.stat(follow_symlinks=False)
+        return found
+
+    files = {}
+    subdirectories = []
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if ignored(entry.name):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                files[normalisePath(entry.path)] = entry.stat(follow_symlinks=False)
+    for found in digestPool().map(walk, subdirectories):
+        files.update(found)
+    return files
+
+
+class ReconcilePlan:
+    """Local paths that look changed outside Perforce: new, modified and missing files."""
+
+    def __init__(self):
+        self.adds = []
+        self.edits = []
+        self.deletes = []
+
+    def paths(self):
+        return self.adds + self.edits + self.deletes
+
+    def summary(self):
+        return "{} new, {} modified and {} deleted files".format(len(self.adds), len(self.edits), len(self.deletes))
+
+
+def findOfflineWork(connection, verify=True):
+    """Compare the workspace on disk with the have list, without a server-side reconcile.
+
+    Files missing from the have list are add candidates and have-list files missing
+    from disk are delete candidates; opened files are left out. Edit candidates are
+    the writable files that aren't opened (reconcile_writable_only = false in
+    config.txt checks every file, for allwrite workspaces), confirmed with one
+    `fstat -Ol` and the digest cache so only files whose content really differs
+    from the have revision are reported.
+    """
+    root = clientRoot(connection)
+    # forced: syncs made outside the plug-in would otherwise look like offline work
+    have, haveRevisions = haveSnapshot.refresh(connection, force=True)
+    with connection.at_exception_level(P4.RAISE_ERROR): # "file(s) not opened"
+        openedFiles = connection.run_opened()
+    opened = set(fileInfo['depotFile'] for fileInfo in openedFiles if isinstance(fileInfo, dict))
+    clientPrefix = '//{}/'.format(connection.client)
+    openedLocal = set(normalisePath(os.path.join(root, fileInfo['clientFile'][len(clientPrefix):]))
+                      for fileInfo in openedFiles
+                      if isinstance(fileInfo, dict) and fileInfo.get('clientFile', '').startswith(clientPrefix))
+
+    ignore = ignorePatterns()
+    local = scanWorkspace(root, ignore)
+    writableOnly = config.getboolean('reconcile_writable_only', fallback=True)
+
+    plan = ReconcilePlan()
+    candidates = {}
+    for path, fileStat in local.items():
+        depotFile = have.get(path)
+        if depotFile is None:
+            if path not in openedLocal and not connection.is_ignored(path):
+                plan.adds.append(path)
+        elif depotFile not in opened and (not writableOnly or fileStat.st_mode & stat.S_IWRITE):
+            candidates[path] = depotFile
+    # the scan skipped ignored names, so versioned files under them aren't missing
+    plan.deletes = [path for path, depotFile in have.items()
+                    if path not in local and depotFile not in opened and not isIgnoredPath(path, root, ignore)]
+
+    if not verify or not candidates:
+        plan.edits = list(candidates)
+        return plan
+    with connection.at_exception_level(P4.RAISE_ERROR):
+        stats = connection.run_fstat('-Ol', '-T', 'depotFile,digest',
+                                     ['{}#{}'.format(depotFile, haveRevisions[depotFile])
+                                      for depotFile in candidates.values()])
+    serverDigests = {fileInfo['depotFile']: fileInfo.get('digest', '').upper()
+                     for fileInfo in stats if isinstance(fileInfo, dict)}
+    localDigests = digestCache.digests(list(candidates))
+    plan.edits = [path for path, depotFile in candidates.items()
+                  if localDigests.get(path) != serverDigests.get(depotFile)]
+    return plan
+
+def p4ReconcileOfflineWork(*args):
+    """Find files changed outside Maya in the background, then open them with one reconcile."""
+    print("p4ReconcileOfflineWork")
+    connectToP4()
+
+    def find():
+        connection = None
+        plan = None
+        error = None
+        try:
+            connection = newP4Connection()
+            plan = findOfflineWork(connection)
+        except Exception as e:
+            error = e
+        finally:
+            if connection is not None and connection.connected():
+                connection.disconnect()
+        maya.utils.executeDeferred(offlineWorkFound, plan, error)
+
+    threading.Thread(target=find, name='P4UCB reconcile', daemon=True).start()
+
+def offlineWorkFound(plan, error):
+    """Runs on the main thread once findOfflineWork has finished."""
+    if error is not None:
+        cmds.confirmDialog(title='Error Reconciling', icon='critical', message=str(error), button=["ok"])
+        return
+    if not plan.paths():
+        cmds.confirmDialog(title='Reconcile', message='No files were changed outside Perforce', button=["ok"])
+        return
+    response = cmds.confirmDialog(title='Reconcile', button=['Open', 'Cancel'],
+                                  message="Found {} changed outside Perforce. Open them for add, edit and delete?".format(plan.summary()))
+    if response != 'Open':
+        return
+    with p4.at_exception_level(P4.RAISE_ERROR):
+        reconcileResult = p4.run_reconcile('-a', '-e', '-d', plan.paths())
+    openedIndex.markOpened(reconcileResult)
+    fileStates.invalidate(fileInfo['depotFile'] for fileInfo in reconcileResult if isinstance(fileInfo, dict))
+    print("Opened {} files".format(len(reconcileResult)))
+
+
+def ignorePatterns():
+    return [pattern.strip() for pattern in config.get('reconcile_ignore', fallback='.*,*.swatches,*.mayaSwatches').split(',')
+            if pattern.strip()]
+
+
+class InotifyWatcher:
+    """Recursive inotify watch of a directory tree (Linux only), through ctypes.
+
+    read() returns the paths changed since the last call. Directories created
+    later are watched as they appear; a removed directory is reported as
+    'directory/...'. None means the kernel queue overflowed and changes were lost.
+    """
+
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct('iIII') # wd, mask, cookie, len; followed by the name
+
+    @staticmethod
+    def available():
+        return sys.platform.startswith('linux') and ctypes.util.find_library('c') is not None
+
+    def __init__(self, root, ignore=()):
+        self.ignore = ignore
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.directories = {} # watch descriptor -> directory
+        try:
+            self.addTree(root)
+        except OSError:
+            self.close()
+            raise
+
+    def ignored(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.ignore)
+
+    def addTree(self, top, changed=None):
+        """Watch top and every directory below it; files found are added to changed."""
+        stack = [top]
+        while stack:
+            directory = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                error = ctypes.get_errno()
+                raise OSError(error, os.strerror(error), directory) # ENOSPC: out of watches
+            self.directories[wd] = directory
+            try:
+                entries = os.scandir(directory)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    if self.ignored(entry.name):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif changed is not None:
+                        changed.append(entry.path) # created before the watch was in place
+
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        changed = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip(b'\0'))
+            offset += self.EVENT.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                return None
+            if mask & self.IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name or self.ignored(name):
+                continue
+            path = os.path.join(directory, name)
+            if not mask & self.IN_ISDIR:
+                changed.append(path)
+            elif mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.addTree(path, changed)
+            elif mask & (self.IN_DELETE | self.IN_MOVED_FROM):
+                changed.append(os.path.join(path, '...'))
+        return changed
+
+    def interrupt(self):
+        pass # read() returns within its timeout
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def sizeSnapshot(root, ignore=()):
+    """{normalised path: (size, mtime)} of every file under root."""
+    return {path: (fileStat.st_size, fileStat.st_mtime_ns)
+            for path, fileStat in scanWorkspace(root, ignore).items()}
+
+def snapshotDifferences(previous, current):
+    return [path for path in set(previous) | set(current) if previous.get(path) != current.get(path)]
+
+
+class PollingWatcher:
+    """Fallback for InotifyWatcher: rescans the tree every watch_poll_interval seconds."""
+
+    def __init__(self, root, ignore=()):
+        self.root = root
+        self.ignore = ignore
+        self.stopping = threading.Event()
+        self.snapshot = self.scan()
+
+    def scan(self):
+        return sizeSnapshot(self.root, self.ignore)
+
+    def read(self, timeout):
+        if self.stopping.wait(config.getfloat('watch_poll_interval', fallback=30)):
+            return []
+        previous = self.snapshot
+        self.snapshot = self.scan()
+        return snapshotDifferences(previous, self.snapshot)
+
+    def interrupt(self):
+        self.stopping.set()
+
+    def close(self):
+        self.stopping.set()
+
+
+class WorkspaceWatcher:
+    """Tracks files changed in the workspace on disk, for watch_workspace = true (config.txt).
+
+    A thread reads changes from InotifyWatcher, or PollingWatcher where inotify is
+    unavailable, and hands them to the main thread once a path has been quiet for
+    watch_debounce seconds. Files the plug-in writes itself (sync, revert) are left
+    out. modifiedNotOpened() is the live set of changed files that aren't opened,
+    ready to be opened with one reconcile.
+    """
+
+    def __init__(self):
+        self.root = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self.backend = None
+        self.modified = set()
+        self.written = {} # path -> time the plug-in itself wrote it (sync, revert)
+
+    def start(self, root):
+        if not config.getboolean('watch_workspace', fallback=False):
+            return
+        root = normalisePath(root)
+        if root == self.root and self.thread is not None and self.thread.is_alive():
+            return
+        self.stop()
+        self.root = root
+        self.modified = set()
+        self.written = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(root, self.stopping), name='P4UCB watcher', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.backend is not None:
+            self.backend.interrupt()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    def createBackend(self, root):
+        if InotifyWatcher.available():
+            try:
+                return InotifyWatcher(root, ignorePatterns())
+            except OSError as e:
+                print("Warning: Cannot watch {} with inotify ({}), polling instead".format(root, e))
+        return PollingWatcher(root, ignorePatterns())
+
+    def run(self, root, stopping):
+        backend = self.backend = self.createBackend(root)
+        debounce = config.getfloat('watch_debounce', fallback=2)
+        pending = {} # path -> time of its last change
+        # sizes and mtimes as of the last event, so a queue overflow only reports real differences
+        snapshot = sizeSnapshot(root, ignorePatterns()) if isinstance(backend, InotifyWatcher) else None
+        try:
+            while not stopping.is_set():
+                changed = backend.read(0.5)
+                now = time.time()
+                if changed is None: # events were lost, compare a full scan with the snapshot
+                    current = sizeSnapshot(root, ignorePatterns())
+                    changed = snapshotDifferences(snapshot, current)
+                    snapshot = current
+                elif snapshot is not None:
+                    self.updateSnapshot(snapshot, changed)
+                for path in changed:
+                    pending[path] = now
+                ready = [path for path, lastChange in pending.items() if now - lastChange >= debounce]
+                for path in ready:
+                    del pending[path]
+                if ready and not stopping.is_set():
+                    maya.utils.executeDeferred(self.deliver, ready)
+        finally:
+            backend.close()
+
+    @staticmethod
+    def updateSnapshot(snapshot, changed):
+        for path in map(normalisePath, changed):
+            if path.endswith(os.sep + '...'): # a removed directory
+                prefix = path[:-3]
+                for removed in [known for known in snapshot if known.startswith(prefix)]:
+                    del snapshot[removed]
+                continue
+            try:
+                fileStat = os.stat(path)
+            except OSError:
+                snapshot.pop(path, None)
+                continue
+            snapshot[path] = (fileStat.st_size, fileStat.st_mtime_ns)
+
+    def deliver(self, paths):
+        if self.written:
+            expiry = time.time() - config.getfloat('watch_debounce', fallback=2) - 5
+            self.written = {path: written for path, written in self.written.items() if written >= expiry}
+        self.modified.update(path for path in map(normalisePath, paths) if path not in self.written)
+
+    def ignoreWritten(self, paths):
+        """Forget changes the plug-in made itself, including events for them still to be delivered."""
+        if self.thread is None:
+            return
+        now = time.time()
+        for path in map(normalisePath, paths):
+            self.modified.discard(path)
+            self.written[path] = now
+
+    def ignoreResults(self, results):
+        """ignoreWritten for the local files in the tagged output of a sync or revert."""
+        self.ignoreWritten(fileInfo['clientFile'] for fileInfo in results or ()
+                           if isinstance(fileInfo, dict) and 'clientFile' in fileInfo)
+
+    def ignoreDepotFiles(self, depotFiles):
+        """ignoreWritten for depot files, e.g. a submit's, whose output has no local paths."""
+        if self.thread is None:
+            return
+        paths = []
+        for depotFile in depotFiles:
+            try:
+                path = clientIndex.depotToLocal(depotFile)
+            except P4Exception:
+                continue
+            if path is not None:
+                paths.append(path)
+        self.ignoreWritten(paths)
+
+    def modifiedNotOpened(self):
+        """The changed paths, minus those of opened files."""
+        if self.root is None:
+            return []
+        clientPrefix = '//{}/'.format(config['client'])
+        opened = set(normalisePath(os.path.join(self.root, fileInfo['clientFile'][len(clientPrefix):]))
+                     for fileInfo in openedIndex.refresh().values()
+                     if fileInfo.get('clientFile', '').startswith(clientPrefix))
+        return sorted(path for path in self.modified if path not in opened)
+
+workspaceWatcher = WorkspaceWatcher()
+
+def startWorkspaceTracking():
+    """Watch the client root for changes and warm the have snapshot in the background."""
+    try:
+        clientIndex.load()
+    except P4Exception as e:
+        print("Warning: Cannot read the workspace root: " + str(e).strip())
+        return
+    workspaceWatcher.start(clientIndex.root)
+    haveSnapshot.refreshInBackground()
+
+def p4OpenModified(*args):
+    """Open the files the workspace watcher saw change, with one reconcile."""
+    print("p4OpenModified")
+    if not config.getboolean('watch_workspace', fallback=False):
+        cmds.confirmDialog(title='Modified Files', message='Set watch_workspace to true in P4 -> Setup Plugin first',
+                           button=["ok"])
+        return
+    connectToP4()
+    paths = workspaceWatcher.modifiedNotOpened()
+    if not paths:
+        cmds.confirmDialog(title='Modified Files', message='No modified files that are not opened', button=["ok"])
+        return
+    listed = "\n".join(paths[:20]) + ("\n..." if len(paths) > 20 else "")
+    response = cmds.confirmDialog(title='Modified Files', button=['Open', 'Cancel'],
+                                  message="{} modified files are not opened:\n\n{}\n\nOpen them for add, edit and delete?".format(len(paths), listed))
+    if response != 'Open':
+        return
+    with p4.at_exception_level(P4.RAISE_ERROR): # unchanged files are only a warning
+        reconcileResult = p4.run_reconcile('-a', '-e', '-d', paths)
+    openedIndex.markOpened(reconcileResult)
+    fileStates.invalidate(fileInfo['depotFile'] for fileInfo in reconcileResult if isinstance(fileInfo, dict))
+    workspaceWatcher.modified.difference_update(paths)
+    print("Opened {} files".format(len([r for r in reconcileResult if isinstance(r, dict)])))
+
 
 def p4Setup(*args):
     """Display a window to allow changing Perforce config."""
-    global config
     print("p4Setup")
 
     setup_window = cmds.window('Bugg Setup')
@@ -281,13 +2444,19 @@ def p4Setup(*args):
             configParser.write(configfile)
         cmds.deleteUI(setup_window)
 
+        #reset config values with new file
+        global config
+        config = readP4Config()
+        connectionManager.reset()
+        openedIndex.invalidate()
+        fileStates.clear()
+        clientIndex.invalidate()
+        haveSnapshot.invalidate()
+        autosave.start()
+
     cmds.button(label='Save', command=save_config)
     cmds.showWindow(setup_window)
 
-    #reset config values with new file
-    p4.disconnect()
-    config = readP4Config()
-
 def p4Update(*args):
     """Update the plug-in from GitHub."""
     resp = urlopen(ARCHIVE_URL, context=ssl.SSLContext())
@@ -296,6 +2465,35 @@ def p4Update(*args):
     with tempfile.TemporaryDirectory() as tmpdirname:
         myzip.extractall(tmpdirname)
         shutil.copyfile(tmpdirname + '/P4UCB-main/plug-ins/p4UCB.py', pluginDir + '/p4UCB.py')
+        # the plug-in relies on the stats, batching and pooling in the bundled P4.py
+        shutil.copyfile(tmpdirname + '/P4UCB-main/plug-ins/P4Library/P4.py', pluginDir + '/P4Library/P4.py')
+
+def p4ShowStats(*args):
+    """Display per-command and per-callback timings."""
+    collector = statsCollector()
+    report = collector.report() if collector else "Performance stats are disabled (performance_stats in config.txt, needs an updated P4Library/P4.py)"
+    stats_window = cmds.window(title='P4 Performance', widthHeight=(720, 400))
+    cmds.paneLayout()
+    cmds.scrollField(text=report, editable=False, wordWrap=False, font='fixedWidthFont')
+    cmds.showWindow(stats_window)
+
+def p4ResetStats(*args):
+    collector = statsCollector()
+    if collector:
+        collector.reset()
+
+def p4ExportStats(*args, path=None):
+    """Write the stats as JSON, to `path` or a file chosen by the user."""
+    collector = statsCollector()
+    if (not collector):
+        return
+    if (not path):
+        result = cmds.fileDialog2(fileMode=0, caption='Export Stats', fileFilter='JSON (*.json)')
+        if (not result):
+            return
+        path = result[0]
+    collector.export(path)
+    print("Exported P4 stats to " + path)
 
 @callback(OpenMaya.MSceneMessage.kAfterSave)
 def save_callback(*args):
@@ -303,18 +2501,11 @@ def save_callback(*args):
     filepath = getRelativeFilePath()
     if (not filepath): #Filepath isn't in directory, ignore
         return
-    connectToP4()
+    connectToP4() # no round trip unless the keepalive dropped the connection
+    startDigestCheck()
 
-    try:
-        fileInfo = p4.run( "files",  filepath)
-
-        #file could still have been deleted in the past
-        if fileInfo[0]['action'] == 'delete':
-            addResponse = cmds.confirmDialog(message="The file you saved: {}, was not found in Perforce, would you like to add it.".format(filepath), button=["add", "cancel"])
-            if (addResponse == 'add'):
-                p4Add(None)
-    except P4Exception:
-        #File check failed, means file isn't in perforce
+    #file could also have been deleted in the past
+    if (not fileStates.inDepot(filepath)):
         if (isFileOpened(filepath)):#file already opened no need to prompt
             return
         addResponse = cmds.confirmDialog(message="The file you saved: {}, was not found in Perforce, would you like to add it.".format(filepath), button=["add", "cancel"])
@@ -324,36 +2515,38 @@ def save_callback(*args):
 @callback(OpenMaya.MSceneMessage.kAfterNew)
 def afterNew_callback(*args):
     """Callback after a new file is made"""
-    ws = cmds.workspace(q=True, dir=True)
-    if (('/' + config['client'] + '/') not in ws): #Filepath isn't in directory, ignore
+    if (not localToDepotPath(cmds.workspace(q=True, dir=True))): #Workspace isn't in the client view, ignore
+        return
+    startWorkspaceTracking()
+    if (syncScope() == 'scene'): #nothing to sync for an empty scene
         return
     connectToP4()
-    try:
-        p4GetLatest(verbose=False) #Sync
-        print("Synced")
-    except P4Exception:
-        print("Already Synced")
+    p4GetLatest(verbose=False) #Sync, runs in the background
+    print("Syncing in background")
 
 @callback(OpenMaya.MSceneMessage.kAfterOpen)
 def afterOpen_callback(*args):
     """Callback after a file is opened"""
 
-    afterNew_callback()
+    scope = syncScope()
+    if (scope == 'full'):
+        afterNew_callback()
+    else:
+        if localToDepotPath(cmds.workspace(q=True, dir=True)):
+            startWorkspaceTracking()
+        p4SyncScene(verbose=False, fullSyncAfter=(scope == 'scene+full'))
 
     filepath = getRelativeFilePath()
     if (not filepath): #Filepath isn't in directory, ignore
         return
-    try:
-        fileInfo = p4.run( "files", filepath)
-        #Didn't fail, file already in perforce, ask to edit
+    if (fileStates.inDepot(filepath)):
+        #file already in perforce, ask to edit
         editResponse = cmds.confirmDialog(title='Check out?', message="Would you like to check out this file for editing?", button=["Check Out", "Don't Check Out"])
         if (editResponse == "Check Out"):
             p4Checkout(None)
-
-    except P4Exception:
-        #File check failed, means file isn't in perforce
+    else:
         addResponse = cmds.confirmDialog(title='Add?', message="This file: {}, was not found in Perforce, would you like to add it.".format(filepath), button=["Add", "Don't Add"])
-        if (addResponse == "yes"):
+        if (addResponse == "Add"):
             p4Add(None)
 
 
@@ -369,6 +2562,14 @@ def close_callback(*args):
     connectToP4()
 
     openedFiles = getOpenedList()
+    check = digestChecker.latest # started after the last save or checkout, only read what is already hashed
+    if (len(openedFiles) > 0 and check is not None and check.covers(openedFiles)
+            and len(check.unchanged(openedFiles, wait=False)) == len(openedFiles)):
+        reverted = revertUnchanged(openedFiles) # releases their locks, revert -a keeps anything changed since
+        print("Opened files are unchanged, reverted {} instead of asking to submit".format(len(reverted)))
+        if len(reverted) == len(openedFiles):
+            return
+        openedFiles = getOpenedList()
     if len(openedFiles) > 0:
         submitResponse = cmds.confirmDialog(title='Submit Changes?', message='Do you want to submit your changes?', button=['Submit', 'Later'])
         if (submitResponse == 'Submit'):
@@ -388,10 +2589,31 @@ def initializePlugin(mobject):
     cmds.menuItem(label='Update Plugin', command=p4Update, parent=custom_menu)
     cmds.menuItem(divider=True)
     cmds.menuItem(label='Sync', command=p4GetLatest, parent=custom_menu)
+    cmds.menuItem(label='Sync Scene Dependencies', command=p4SyncScene, parent=custom_menu)
     cmds.menuItem(label='Add To Perforce', command=p4Add, parent=custom_menu)
     cmds.menuItem(label='Start Editing', command=p4Checkout, parent=custom_menu)
     cmds.menuItem(label='Revert', command=p4Revert, parent=custom_menu)
     cmds.menuItem(label='Submit', command=p4Submit, parent=custom_menu)
+    cmds.menuItem(label='Resume Pending Submits', command=p4ResumeSubmits, parent=custom_menu)
+    cmds.menuItem(label='Shelve Autosave Now', command=autosave.trigger, parent=custom_menu)
+    batch_menu = cmds.menuItem(label='Selection / Directory', subMenu=True, parent=custom_menu)
+    cmds.menuItem(label='Start Editing Selection', command=p4CheckoutSelection, parent=batch_menu)
+    cmds.menuItem(label='Start Editing Directory...', command=p4CheckoutDirectory, parent=batch_menu)
+    cmds.menuItem(label='Add Selection To Perforce', command=p4AddSelection, parent=batch_menu)
+    cmds.menuItem(label='Add Directory To Perforce...', command=p4AddDirectory, parent=batch_menu)
+    cmds.menuItem(label='Revert Selection', command=p4RevertSelection, parent=batch_menu)
+    cmds.menuItem(label='Revert Directory...', command=p4RevertDirectory, parent=batch_menu)
+    cmds.menuItem(label='Reconcile Offline Work', command=p4ReconcileOfflineWork, parent=batch_menu)
+    cmds.menuItem(label='Open Modified Files...', command=p4OpenModified, parent=batch_menu)
+    cmds.menuItem(divider=True, parent=custom_menu)
+    performance_menu = cmds.menuItem(label='Performance', subMenu=True, parent=custom_menu)
+    cmds.menuItem(label='Show Stats', command=p4ShowStats, parent=performance_menu)
+    cmds.menuItem(label='Reset Stats', command=p4ResetStats, parent=performance_menu)
+    cmds.menuItem(label='Export Stats...', command=p4ExportStats, parent=performance_menu)
+
+    if pendingSubmits.load():
+        maya.utils.executeDeferred(p4ResumeSubmits, ask=True)
+    autosave.start()
 
 
 # Uninitialize the script plug-in
@@ -399,6 +2621,17 @@ def uninitializePlugin(mobject):
     """Remove the plugin from Maya."""
     mplugin = OpenMayaMPx.MFnPlugin(mobject)
     cmds.deleteUI(custom_menu)
+    if config.get('stats_export', fallback=''):
+        p4ExportStats(path=config['stats_export'])
+    syncWorker.stop()
+    submitWorker.stop()
+    autosave.stop()
+    digestChecker.stop()
+    workspaceWatcher.stop()
+    if digestExecutor is not None:
+        digestExecutor.shutdown(wait=False)
+    digestCache.close()
+    connectionManager.reset()
 
     try:
         for fn in callback_fns: